@@ -7,6 +7,8 @@ import numpy as np
 import torch
 from tool.segmentor import Segmentor
 from tool.detector import Detector
+from tool.embedding_cache import frame_fingerprint
+from tool.model_registry import get_model
 
 import cv2
 import os
@@ -35,11 +37,12 @@ class SegTracker():
         """
         self.sam = Segmentor(sam_args)
         self.tracker = get_aot(aot_args)
-        self.detector = Detector(self.sam.device)
+        self._detector = None  # GroundingDINO is only built for text prompts
         self.sam_gap = segtracker_args['sam_gap']
         self.min_area = segtracker_args['min_area']
         self.max_obj_num = segtracker_args['max_obj_num']
         self.min_new_obj_iou = segtracker_args['min_new_obj_iou']
+        self.sam_warm_start = segtracker_args.get('sam_warm_start', False)
         self.reference_objs_list = []
         self.object_idx = 1
         self.origin_merged_mask = None  # init with 0 / segment-everything or update
@@ -49,15 +52,33 @@ class SegTracker():
         self.everything_points = []
         self.everything_labels = []
        
-    def seg(self,frame):
+    @property
+    def detector(self):
+        if self._detector is None:
+            self.init_detector()
+        return self._detector
+
+    def init_detector(self):
+        '''
+        Build (or fetch the process-wide) GroundingDINO detector. Called on first use of self.detector.
+        '''
+        self._detector = get_model(('groundingdino', str(self.sam.device)), lambda: Detector(self.sam.device))
+
+    def seg(self,frame,prior_mask=None,frame_key=None):
         '''
         Arguments:
             frame: numpy array (h,w,3)
+            prior_mask: numpy array (h,w), objects already tracked in this frame.
+                If given, SAM is warm-started from these objects instead of a full point grid.
+            frame_key: identity of the frame in the on-disk embedding cache, e.g. (video hash, frame index).
+                The content hash of the frame is used by default.
         Return:
             origin_merged_mask: numpy array (h,w)
         '''
         frame = frame[:, :, ::-1]
-        anns = self.sam.everything_generator.generate(frame)
+        if frame_key is None and self.sam.disk_cache is not None:
+            frame_key = frame_fingerprint(frame)
+        anns = self.sam.everything_generator.generate(frame, prior_mask, frame_key)
 
         # anns is a list recording all predictions in an image
         if len(anns) == 0:
@@ -116,8 +137,10 @@ class SegTracker():
         '''
         pred_mask = self.tracker.track(frame)
         if update_memory:
-            self.tracker.update_memory(pred_mask)
-        return pred_mask.squeeze(0).squeeze(0).detach().cpu().numpy().astype(np.uint8)
+            # memorize the decoder resolution label while the full resolution one is copied to the host
+            self.tracker.update_memory()
+        self.tracker.wait_label()
+        return pred_mask.squeeze(0).squeeze(0).numpy()
     
     def get_tracking_objs(self):
         objs = set()
@@ -157,6 +180,25 @@ class SegTracker():
     def restart_tracker(self):
         self.tracker.restart()
 
+    def snapshot(self):
+        '''
+        Tracker memories and tracked objects after the last tracked frame, to rewind to this frame with restore()
+        instead of restarting the tracker and re-tracking from the first frame.
+        '''
+        return {
+            'tracker': self.tracker.snapshot(),
+            'reference_objs_list': list(self.reference_objs_list),
+            'object_idx': self.object_idx,
+            'origin_merged_mask': None if self.origin_merged_mask is None else self.origin_merged_mask.copy(),
+        }
+
+    def restore(self, snapshot):
+        self.tracker.restore(snapshot['tracker'])
+        self.reference_objs_list = list(snapshot['reference_objs_list'])
+        self.object_idx = snapshot['object_idx']
+        origin_merged_mask = snapshot['origin_merged_mask']
+        self.origin_merged_mask = None if origin_merged_mask is None else origin_merged_mask.copy()
+
     def seg_acc_bbox(self, origin_frame: np.ndarray, bbox: np.ndarray,):
         ''''
         parameters:
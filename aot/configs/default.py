@@ -98,6 +98,8 @@ class DefaultEngineConfig():
         self.TEST_MULTISCALE = [1]
         self.TEST_MAX_SHORT_EDGE = None
         self.TEST_MAX_LONG_EDGE = 800 * 1.3
+        self.TEST_SIZE_BUCKET = None  # round input sizes to multiples of it (a multiple of 16, e.g. 64) to reuse compiled graphs
+        self.TEST_COMPILE = False  # torch.compile the encoder, LSTT and decoder, True or a torch.compile mode
         self.TEST_WORKERS = 4
 
         # GPU distribution
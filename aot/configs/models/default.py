@@ -23,5 +23,8 @@ class DefaultModelConfig():
         self.TRAIN_AUG_TYPE = 'v1'
 
         self.TEST_LONG_TERM_MEM_GAP = 9999
+        self.TEST_LONG_TERM_MEM_MAX = -1  # max long-term memory frames, -1 for unbounded
+        self.TEST_LONG_TERM_MEM_POLICY = 'recent'  # frame to evict when full: recent, confidence or usage
+        self.TEST_LONG_TERM_MEM_DTYPE = None  # long-term memory storage: None (compute dtype), float16, bfloat16 or int8, short-term memory is not affected
 
         self.TEST_SHORT_TERM_MEM_SKIP = 1
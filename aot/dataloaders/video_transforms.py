@@ -598,13 +598,21 @@ class MultiRestrictSize(object):
                  flip=False,
                  multi_scale=[1.3],
                  align_corners=True,
-                 max_stride=16):
+                 max_stride=16,
+                 size_bucket=None):
         self.max_short_edge = max_short_edge
         self.max_long_edge = max_long_edge
         self.multi_scale = multi_scale
         self.flip = flip
         self.align_corners = align_corners
         self.max_stride = max_stride
+        # round the edges to multiples of size_bucket (a multiple of
+        # max_stride) instead, so that frames share a few input sizes
+        if size_bucket is not None and size_bucket % max_stride != 0:
+            raise ValueError(
+                'size_bucket must be a multiple of max_stride ({}), got {}.'.
+                format(max_stride, size_bucket))
+        self.size_bucket = size_bucket
 
     def __call__(self, sample):
         samples = []
@@ -637,22 +645,19 @@ class MultiRestrictSize(object):
             new_h = int(new_h * scale)
             new_w = int(new_w * scale)
 
+            stride = self.max_stride if self.size_bucket is None else self.size_bucket
             if self.align_corners:
-                if (new_h - 1) % self.max_stride != 0:
+                if (new_h - 1) % stride != 0:
                     new_h = int(
-                        np.around((new_h - 1) / self.max_stride) *
-                        self.max_stride + 1)
-                if (new_w - 1) % self.max_stride != 0:
+                        max(np.around((new_h - 1) / stride), 1) * stride + 1)
+                if (new_w - 1) % stride != 0:
                     new_w = int(
-                        np.around((new_w - 1) / self.max_stride) *
-                        self.max_stride + 1)
+                        max(np.around((new_w - 1) / stride), 1) * stride + 1)
             else:
-                if new_h % self.max_stride != 0:
-                    new_h = int(
-                        np.around(new_h / self.max_stride) * self.max_stride)
-                if new_w % self.max_stride != 0:
-                    new_w = int(
-                        np.around(new_w / self.max_stride) * self.max_stride)
+                if new_h % stride != 0:
+                    new_h = int(max(np.around(new_h / stride), 1) * stride)
+                if new_w % stride != 0:
+                    new_w = int(max(np.around(new_w / stride), 1) * stride)
 
             if new_h == h and new_w == w:
                 samples.append(sample)
@@ -0,0 +1,150 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from networks.layers.normalization import FrozenBatchNorm2d
+
+BATCH_NORMS = (nn.BatchNorm2d, FrozenBatchNorm2d)
+ACTIVATIONS = (nn.ReLU, nn.ReLU6)
+
+
+def fold_conv_bn(conv, bn):
+    # conv followed by an eval-mode bn is a single conv
+    eps = bn.eps if isinstance(bn, nn.BatchNorm2d) else bn.epsilon
+    scale = (bn.running_var + eps).rsqrt()
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    bias = -bn.running_mean * scale
+    if bn.bias is not None:
+        bias = bias + bn.bias
+    if conv.bias is not None:
+        bias = bias + conv.bias * scale
+
+    conv.weight = nn.Parameter(
+        (conv.weight * scale.view(-1, 1, 1, 1)).detach(),
+        requires_grad=False)
+    conv.bias = nn.Parameter(bias.detach(), requires_grad=False)
+
+
+def trace_module_pairs(module, probe, first_types, second_types):
+    """
+    Runs probe through module and returns the (first, second) submodule
+    pairs, by qualified name, where second directly consumes the output of
+    first. Modules that run more than once are left out.
+    """
+    names = {m: name for name, m in module.named_modules()}
+    outputs = {}
+    calls = {}
+    pairs = []
+    handles = []
+
+    def record_output(m, inputs, output):
+        calls[m] = calls.get(m, 0) + 1
+        # keep the output alive so that its id is not reused
+        outputs[id(output)] = (m, output)
+
+    def record_input(m, inputs):
+        calls[m] = calls.get(m, 0) + 1
+        if len(inputs) > 0 and id(inputs[0]) in outputs:
+            pairs.append((outputs[id(inputs[0])][0], m))
+
+    for m in names:
+        if isinstance(m, first_types):
+            handles.append(m.register_forward_hook(record_output))
+        elif isinstance(m, second_types):
+            handles.append(m.register_forward_pre_hook(record_input))
+    try:
+        with torch.no_grad():
+            module(probe)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    consumers = {}
+    for first, second in pairs:
+        consumers[first] = consumers.get(first, 0) + 1
+    return [(names[first], names[second]) for first, second in pairs
+            if calls[first] == 1 and calls[second] == 1
+            and consumers[first] == 1]
+
+
+def replace_module(module, name, new_module):
+    parent_name, _, attr = name.rpartition('.')
+    parent = module.get_submodule(parent_name) if parent_name else module
+    setattr(parent, attr, new_module)
+
+
+class ConvActivation(nn.Module):
+    def __init__(self, conv, activation):
+        super().__init__()
+        self.conv = conv
+        self.activation = activation
+
+    def forward(self, x):
+        return self.activation(self.conv(x))
+
+
+class ChannelsLastEncoder(nn.Module):
+    """
+    Runs an encoder in channels_last layout and returns its features in the
+    default layout, as the LSTT views them as sequences.
+    """
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        xs = self.encoder(x.contiguous(memory_format=torch.channels_last))
+        return [x.contiguous() for x in xs]
+
+
+def export_encoder(encoder,
+                   channels_last=True,
+                   fuse_activation=False,
+                   probe_size=(129, 129),
+                   atol=1e-3):
+    """
+    Inference form of an encoder in eval mode: each BatchNorm that directly
+    follows a convolution is folded into it, the convolutions run in
+    channels_last layout, and with fuse_activation each conv is merged with
+    its ReLU/ReLU6 into one module (which fusing backends such as
+    torch.compile or oneDNN lower to one kernel).
+
+    The exported encoder is checked against the original on a random probe
+    and the original is returned if their features differ by more than
+    atol relative to the feature scale.
+    """
+    param = next(encoder.parameters())
+    probe = torch.rand((1, 3) + tuple(probe_size),
+                       device=param.device,
+                       dtype=param.dtype)
+
+    exported = copy.deepcopy(encoder).eval()
+    for conv_name, bn_name in trace_module_pairs(exported, probe,
+                                                 (nn.Conv2d, ), BATCH_NORMS):
+        fold_conv_bn(exported.get_submodule(conv_name),
+                     exported.get_submodule(bn_name))
+        replace_module(exported, bn_name, nn.Identity())
+    if fuse_activation:
+        # folded bns are identities, so the activations consume the conv outputs
+        for conv_name, act_name in trace_module_pairs(exported, probe,
+                                                      (nn.Conv2d, ),
+                                                      ACTIVATIONS):
+            replace_module(
+                exported, conv_name,
+                ConvActivation(exported.get_submodule(conv_name),
+                               exported.get_submodule(act_name)))
+            replace_module(exported, act_name, nn.Identity())
+    if channels_last:
+        exported = ChannelsLastEncoder(exported)
+
+    with torch.no_grad():
+        xs = encoder(probe)
+        new_xs = exported(probe)
+    for x, new_x in zip(xs, new_xs):
+        err = (x - new_x).abs().max() / x.abs().max().clamp(min=1e-6)
+        if x.size() != new_x.size() or not err <= atol:
+            print('Encoder export changed its outputs, keeping the original.')
+            return encoder
+    return exported
@@ -599,8 +599,10 @@ class SwinTransformer(nn.Module):
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         # stochastic depth
+        # on cpu, so that the model can also be built on the meta device
         dpr = [
-            x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))
+            x.item() for x in torch.linspace(
+                0, drop_path_rate, sum(depths), device="cpu")
         ]  # stochastic depth decay rule
 
         # build layers
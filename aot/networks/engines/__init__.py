@@ -1,5 +1,6 @@
 from networks.engines.aot_engine import AOTEngine, AOTInferEngine
 from networks.engines.deaot_engine import DeAOTEngine, DeAOTInferEngine
+from networks.engines.multi_stream_engine import MultiStreamInferEngine
 
 
 def build_engine(name, phase='train', **kwargs):
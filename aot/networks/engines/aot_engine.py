@@ -8,6 +8,8 @@ from utils.math import generate_permute_matrix
 from utils.image import one_hot_mask
 
 from networks.layers.basic import seq_to_2d
+from networks.engines.memory import LongTermMemory, memories_require_grad, \
+    stack_memories, select_memories
 
 
 class AOTEngine(nn.Module):
@@ -15,7 +17,10 @@ class AOTEngine(nn.Module):
                  aot_model,
                  gpu_id=0,
                  long_term_mem_gap=9999,
-                 short_term_mem_skip=1):
+                 short_term_mem_skip=1,
+                 max_long_term_mem=-1,
+                 long_term_mem_policy='recent',
+                 long_term_mem_dtype=None):
         super().__init__()
 
         self.cfg = aot_model.cfg
@@ -26,6 +31,15 @@ class AOTEngine(nn.Module):
         self.gpu_id = gpu_id
         self.long_term_mem_gap = long_term_mem_gap
         self.short_term_mem_skip = short_term_mem_skip
+        # max number of long-term memory frames (-1 for unbounded) and the
+        # policy choosing which frame to evict, see networks/engines/memory.py
+        self.max_long_term_mem = max_long_term_mem
+        self.long_term_mem_policy = long_term_mem_policy
+        # storage dtype of the long-term memory, None for the compute dtype.
+        # Short-term memories stay in the compute dtype: they hold only the
+        # last short_term_mem_skip frames and are replaced every frame, so
+        # they do not grow and casting them would cost a conversion per frame.
+        self.long_term_mem_dtype = long_term_mem_dtype
         self.losses = None
 
         self.restart_engine()
@@ -240,10 +254,7 @@ class AOTEngine(nn.Module):
 
         lstt_embs, lstt_curr_memories, lstt_long_memories, lstt_short_memories = self.curr_lstt_output
 
-        if self.long_term_memories is None:
-            self.long_term_memories = lstt_long_memories
-        else:
-            self.update_long_term_memory(lstt_long_memories)
+        self.update_long_term_memory(lstt_long_memories, is_reference=True)
 
         self.last_mem_step = self.frame_step
 
@@ -279,18 +290,43 @@ class AOTEngine(nn.Module):
 
         lstt_embs, lstt_curr_memories, lstt_long_memories, lstt_short_memories = self.curr_lstt_output
 
-        if self.long_term_memories is None:
-            self.long_term_memories = lstt_long_memories
-        else:
-            self.update_long_term_memory(lstt_long_memories)
+        self.update_long_term_memory(lstt_long_memories)
         self.last_mem_step = frame_step
 
         self.short_term_memories_list = [lstt_short_memories]
         self.short_term_memories = lstt_short_memories
 
-    def update_long_term_memory(self, new_long_term_memories):
+    def init_long_term_memory(self, long_term_memories):
+        if memories_require_grad(long_term_memories):
+            # autograd can not go through in-place writes, so memories are
+            # concatenated during training
+            self.long_term_memory_store = None
+            self.long_term_memories = long_term_memories
+        else:
+            self.long_term_memory_store = LongTermMemory(
+                long_term_memories,
+                max_frames=self.max_long_term_mem,
+                policy=self.long_term_mem_policy,
+                dtype=self.long_term_mem_dtype)
+            self.long_term_memories = self.long_term_memory_store.views()
+
+    def update_long_term_memory(self,
+                                new_long_term_memories,
+                                is_reference=False):
         if self.long_term_memories is None:
-            self.long_term_memories = new_long_term_memories
+            self.init_long_term_memory(new_long_term_memories)
+            return
+        if self.long_term_memory_store is not None and \
+                not memories_require_grad(new_long_term_memories):
+            confidence = 1.
+            if not is_reference and self.long_term_mem_policy == 'confidence':
+                confidence = self.prediction_confidence()
+            self.long_term_memory_store.append(new_long_term_memories,
+                                               pinned=is_reference,
+                                               confidence=confidence)
+            self.long_term_memories = self.long_term_memory_store.views()
+            return
+        self.long_term_memory_store = None
         updated_long_term_memories = []
         for new_long_term_memory, last_long_term_memory in zip(
                 new_long_term_memories, self.long_term_memories):
@@ -337,6 +373,17 @@ class AOTEngine(nn.Module):
                 self.update_long_term_memory(lstt_curr_memories)
             self.last_mem_step = self.frame_step
 
+    def prediction_confidence(self):
+        if self.pred_id_logits is None:
+            return 1.
+        # mean probability of the predicted label, over used identities
+        confidence = []
+        for batch_idx, obj_num in enumerate(self.obj_nums):
+            prob = torch.softmax(
+                self.pred_id_logits[batch_idx, :(obj_num + 1)].float(), dim=0)
+            confidence.append(prob.max(dim=0)[0].mean())
+        return torch.stack(confidence).mean()
+
     def match_propogate_one_frame(self, img=None, img_embs=None):
         self.frame_step += 1
         if img_embs is None:
@@ -346,12 +393,23 @@ class AOTEngine(nn.Module):
             curr_enc_embs = img_embs
         self.curr_enc_embs = curr_enc_embs
 
-        self.curr_lstt_output = self.AOT.LSTT_forward(curr_enc_embs,
-                                                      self.long_term_memories,
-                                                      self.short_term_memories,
-                                                      None,
-                                                      pos_emb=self.pos_emb,
-                                                      size_2d=self.enc_size_2d)
+        if self.long_term_mem_policy == 'usage' and \
+                self.long_term_memory_store is not None:
+            long_term_attn_usage = []
+        else:
+            long_term_attn_usage = None
+
+        self.curr_lstt_output = self.AOT.LSTT_forward(
+            curr_enc_embs,
+            self.long_term_memories,
+            self.short_term_memories,
+            None,
+            pos_emb=self.pos_emb,
+            size_2d=self.enc_size_2d,
+            long_term_attn_usage=long_term_attn_usage)
+
+        if long_term_attn_usage is not None:
+            self.long_term_memory_store.record_usage(long_term_attn_usage)
 
     def decode_current_logits(self, output_size=None):
         curr_enc_embs = self.curr_enc_embs
@@ -359,7 +417,17 @@ class AOTEngine(nn.Module):
 
         pred_id_logits = self.AOT.decode_id_logits(curr_lstt_embs,
                                                    curr_enc_embs)
+        pred_id_logits = self.process_id_logits(pred_id_logits)
 
+        if output_size is not None:
+            pred_id_logits = F.interpolate(pred_id_logits,
+                                           size=output_size,
+                                           mode="bilinear",
+                                           align_corners=self.align_corners)
+
+        return pred_id_logits
+
+    def process_id_logits(self, pred_id_logits):
         if self.enable_id_shuffle:  # reverse shuffle
             pred_id_logits = torch.einsum('bohw,bto->bthw', pred_id_logits,
                                           self.id_shuffle_matrix)
@@ -371,12 +439,6 @@ class AOTEngine(nn.Module):
 
         self.pred_id_logits = pred_id_logits
 
-        if output_size is not None:
-            pred_id_logits = F.interpolate(pred_id_logits,
-                                           size=output_size,
-                                           mode="bilinear",
-                                           align_corners=self.align_corners)
-
         return pred_id_logits
 
     def predict_current_mask(self, output_size=None, return_prob=False):
@@ -457,6 +519,7 @@ class AOTEngine(nn.Module):
         self.input_size_2d = None
 
         self.long_term_memories = None
+        self.long_term_memory_store = None
         self.short_term_memories_list = []
         self.short_term_memories = None
 
@@ -469,6 +532,7 @@ class AOTEngine(nn.Module):
         self.curr_enc_embs = None
         self.curr_memories = None
         self.curr_id_embs = None
+        self.pred_id_logits = None
 
         if enable_id_shuffle:
             self.id_shuffle_matrix = generate_permute_matrix(
@@ -481,6 +545,212 @@ class AOTEngine(nn.Module):
         self.enc_size_2d = enc_size
         self.enc_hw = self.enc_size_2d[0] * self.enc_size_2d[1]
 
+    def snapshot(self):
+        """
+        State of the engine between frames, i.e. after add_reference_frame or
+        update_short_term_memory, to be restored with restore(). Tensors are
+        shared with the engine, which replaces them instead of writing into
+        them, and the long-term memory store is forked (copy-on-write).
+        """
+        store = self.long_term_memory_store
+        return {
+            'batch_size': self.batch_size,
+            'frame_step': self.frame_step,
+            'last_mem_step': self.last_mem_step,
+            'obj_nums': copy_state(self.obj_nums),
+            'enable_id_shuffle': self.enable_id_shuffle,
+            'id_shuffle_matrix': self.id_shuffle_matrix,
+            'pos_emb': self.pos_emb,
+            'enc_size_2d': self.enc_size_2d,
+            'input_size_2d': self.input_size_2d,
+            'long_term_memory_store': None if store is None else store.fork(),
+            'long_term_memories':
+            None if store is not None else copy_state(self.long_term_memories),
+            'short_term_memories_list':
+            copy_state(self.short_term_memories_list),
+        }
+
+    def restore(self, snapshot):
+        self.restart_engine(snapshot['batch_size'])
+        for name in [
+                'frame_step', 'last_mem_step', 'enable_id_shuffle',
+                'id_shuffle_matrix', 'pos_emb'
+        ]:
+            setattr(self, name, snapshot[name])
+        self.obj_nums = copy_state(snapshot['obj_nums'])
+        if snapshot['enc_size_2d'] is not None:
+            self.update_size(snapshot['input_size_2d'],
+                             snapshot['enc_size_2d'])
+
+        store = snapshot['long_term_memory_store']
+        if store is not None:
+            # the snapshot stays valid for further restores
+            self.long_term_memory_store = store.fork()
+            self.long_term_memories = self.long_term_memory_store.views()
+        else:
+            self.long_term_memories = copy_state(
+                snapshot['long_term_memories'])
+        self.short_term_memories_list = copy_state(
+            snapshot['short_term_memories_list'])
+        if len(self.short_term_memories_list) > 0:
+            self.short_term_memories = self.short_term_memories_list[0]
+
+
+def copy_state(state):
+    # copies the lists of a state, tensors are shared
+    if isinstance(state, list):
+        return [copy_state(e) for e in state]
+    return state
+
+
+def clone_state(state):
+    # copies the tensors of a state, compacting views of larger tensors
+    if torch.is_tensor(state):
+        return state.clone()
+    if isinstance(state, LongTermMemory):
+        return state.state_dict()
+    if isinstance(state, (list, tuple)):
+        return type(state)(clone_state(e) for e in state)
+    if isinstance(state, dict):
+        return {key: clone_state(value) for key, value in state.items()}
+    return state
+
+
+def save_snapshot(snapshot, path):
+    """
+    Writes a snapshot of an AOTEngine or AOTInferEngine to path. Only the
+    valid long-term memory frames are written, in their storage dtype.
+    """
+    torch.save(clone_state(snapshot), path)
+
+
+def load_snapshot(path, map_location=None):
+    def load_stores(state):
+        if isinstance(state, list):
+            return [load_stores(e) for e in state]
+        if not isinstance(state, dict):
+            return state
+        state = dict(state)
+        if state.get('long_term_memory_store') is not None:
+            state['long_term_memory_store'] = LongTermMemory.from_state_dict(
+                state['long_term_memory_store'])
+        if 'engines' in state:
+            state['engines'] = load_stores(state['engines'])
+        return state
+
+    return load_stores(
+        torch.load(path, map_location=map_location, weights_only=True))
+
+
+def group_engines(aot_engines):
+    # engines whose long-term memories hold equally many frames can be
+    # propagated as one batch
+    groups = {}
+    for idx, aot_engine in enumerate(aot_engines):
+        store = aot_engine.long_term_memory_store
+        if store is None or aot_engine.short_term_memories is None:
+            key = idx
+        else:
+            key = ('batch', store.num_frames, aot_engine.enc_size_2d)
+        groups.setdefault(key, []).append(idx)
+    return list(groups.values())
+
+
+def stack_long_term_memories(aot_engines, cache):
+    # stacked long-term memories only change every long_term_mem_gap frames,
+    # so they are kept in cache until an engine updates its memory
+    stores = tuple(aot_engine.long_term_memory_store
+                   for aot_engine in aot_engines)
+    steps = tuple(store.step for store in stores)
+    key = tuple(id(aot_engine) for aot_engine in aot_engines)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == stores and cached[1] == steps:
+        return cached[2]
+    stacked = stack_memories([store.views() for store in stores], dim=1)
+    cache[key] = (stores, steps, stacked)
+    return stacked
+
+
+def release_stacked_memories(cache, engine_groups):
+    # drops the stacked memories of groups that were not propagated
+    keys = set(
+        tuple(id(aot_engine) for aot_engine in group)
+        for group in engine_groups)
+    for key in list(cache.keys()):
+        if key not in keys:
+            del cache[key]
+
+
+def match_propogate_engines(aot_model,
+                            aot_engines,
+                            img_embs,
+                            cache,
+                            img_index=None):
+    """
+    Propagates several engines, e.g. the identity groups of an
+    AOTInferEngine, with one batched LSTT pass.
+    img_embs: encoder outputs of the current frames, one row per image
+    img_index: row of img_embs of each engine, None if they share one image
+    Returns the batched LSTT outputs and decoder shortcuts, for
+    decode_engines.
+    """
+    group_size = len(aot_engines)
+    for aot_engine in aot_engines:
+        aot_engine.frame_step += 1
+
+    if img_index is None:
+        # one image, only the LSTT input and the top decoder input are
+        # expanded, the other shortcuts broadcast in the decoder
+        group_embs = list(img_embs[:-1]) + [
+            img_embs[-1].expand(group_size, -1, -1, -1)
+        ]
+        engine_embs = [img_embs] * group_size
+    else:
+        group_embs = [emb.index_select(0, img_index) for emb in img_embs]
+        engine_embs = [[emb.narrow(0, int(row), 1) for emb in img_embs]
+                       for row in img_index.tolist()]
+
+    long_term_memories = stack_long_term_memories(aot_engines, cache)
+    short_term_memories = stack_memories(
+        [aot_engine.short_term_memories for aot_engine in aot_engines], dim=0)
+    pos_emb = aot_engines[0].pos_emb.expand(-1, group_size, -1)
+    if aot_engines[0].long_term_mem_policy == 'usage':
+        long_term_attn_usage = []
+    else:
+        long_term_attn_usage = None
+
+    lstt_embs, lstt_curr_memories, lstt_long_memories, lstt_short_memories = aot_model.LSTT_forward(
+        group_embs,
+        long_term_memories,
+        short_term_memories,
+        None,
+        pos_emb=pos_emb,
+        size_2d=aot_engines[0].enc_size_2d,
+        long_term_attn_usage=long_term_attn_usage)
+
+    for idx, aot_engine in enumerate(aot_engines):
+        aot_engine.curr_enc_embs = engine_embs[idx]
+        aot_engine.curr_lstt_output = (
+            [emb.narrow(1, idx, 1) for emb in lstt_embs],
+            select_memories(lstt_curr_memories, idx, dim=1),
+            select_memories(lstt_long_memories, idx, dim=1),
+            select_memories(lstt_short_memories, idx, dim=0))
+        if long_term_attn_usage is not None:
+            aot_engine.long_term_memory_store.record_usage(
+                [usage.narrow(0, idx, 1) for usage in long_term_attn_usage])
+
+    return lstt_embs, group_embs
+
+
+def decode_engines(aot_model, aot_engines, lstt_embs, group_embs):
+    # one decoder pass for engines propagated by match_propogate_engines,
+    # then the per engine masking of unused identities
+    group_logits = aot_model.decode_id_logits(lstt_embs, group_embs)
+    return torch.cat([
+        aot_engine.process_id_logits(group_logits.narrow(0, idx, 1))
+        for idx, aot_engine in enumerate(aot_engines)
+    ], dim=0)
+
 
 class AOTInferEngine(nn.Module):
     def __init__(self,
@@ -488,7 +758,10 @@ class AOTInferEngine(nn.Module):
                  gpu_id=0,
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
-                 max_aot_obj_num=None):
+                 max_aot_obj_num=None,
+                 max_long_term_mem=-1,
+                 long_term_mem_policy='recent',
+                 long_term_mem_dtype=None):
         super().__init__()
 
         self.cfg = aot_model.cfg
@@ -502,6 +775,11 @@ class AOTInferEngine(nn.Module):
         self.gpu_id = gpu_id
         self.long_term_mem_gap = long_term_mem_gap
         self.short_term_mem_skip = short_term_mem_skip
+        self.max_long_term_mem = max_long_term_mem
+        self.long_term_mem_policy = long_term_mem_policy
+        self.long_term_mem_dtype = long_term_mem_dtype
+        # propagate sub-engines with equally long memories as one batch
+        self.batch_engines = True
 
         self.aot_engines = []
 
@@ -511,6 +789,9 @@ class AOTInferEngine(nn.Module):
         del (self.aot_engines)
         self.aot_engines = []
         self.obj_nums = None
+        self.engine_groups = []
+        self.group_outputs = []
+        self.stacked_long_term_memories = {}
 
     def separate_mask(self, mask, obj_nums):
         if mask is None:
@@ -587,9 +868,7 @@ class AOTInferEngine(nn.Module):
         self.obj_nums = obj_nums
         aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
         while (aot_num > len(self.aot_engines)):
-            new_engine = AOTEngine(self.AOT, self.gpu_id,
-                                   self.long_term_mem_gap,
-                                   self.short_term_mem_skip)
+            new_engine = self.build_sub_engine()
             new_engine.eval()
             self.aot_engines.append(new_engine)
 
@@ -607,19 +886,103 @@ class AOTInferEngine(nn.Module):
             if img_embs is None:  # reuse image embeddings
                 img_embs = aot_engine.curr_enc_embs
 
+        self.ungroup_engines()
         self.update_size()
 
+    def build_sub_engine(self):
+        return AOTEngine(self.AOT, self.gpu_id, self.long_term_mem_gap,
+                         self.short_term_mem_skip, self.max_long_term_mem,
+                         self.long_term_mem_policy, self.long_term_mem_dtype)
+
+    def snapshot(self):
+        """
+        State of all sub-engines between frames (see AOTEngine.snapshot),
+        e.g. to rewind to this frame later with restore() or to write to
+        disk with save_snapshot().
+        """
+        return {
+            'obj_nums': self.obj_nums,
+            'engines': [aot_engine.snapshot() for aot_engine in self.aot_engines]
+        }
+
+    def restore(self, snapshot):
+        self.restart_engine()
+        self.obj_nums = snapshot['obj_nums']
+        for engine_snapshot in snapshot['engines']:
+            new_engine = self.build_sub_engine()
+            new_engine.eval()
+            new_engine.restore(engine_snapshot)
+            self.aot_engines.append(new_engine)
+        self.ungroup_engines()
+        if len(self.aot_engines) > 0:
+            self.update_size()
+
+    def fork(self):
+        # an engine continuing from the current frame, sharing the memories
+        # copy-on-write
+        engine = type(self)(self.AOT, self.gpu_id, self.long_term_mem_gap,
+                            self.short_term_mem_skip, self.max_aot_obj_num,
+                            self.max_long_term_mem, self.long_term_mem_policy,
+                            self.long_term_mem_dtype)
+        engine.batch_engines = self.batch_engines
+        engine.train(self.training)
+        engine.restore(self.snapshot())
+        return engine
+
+    def ungroup_engines(self):
+        # after adding a reference frame each sub-engine holds its own output
+        self.engine_groups = [[idx] for idx in range(len(self.aot_engines))]
+        self.group_outputs = [None] * len(self.aot_engines)
+
+    def group_engines(self):
+        if not self.batch_engines:
+            return [[idx] for idx in range(len(self.aot_engines))]
+        return group_engines(self.aot_engines)
+
     def match_propogate_one_frame(self, img=None):
         img_embs = None
-        for aot_engine in self.aot_engines:
-            aot_engine.match_propogate_one_frame(img, img_embs=img_embs)
+        self.engine_groups = self.group_engines()
+        self.group_outputs = []
+        for group in self.engine_groups:
+            if len(group) == 1:
+                self.aot_engines[group[0]].match_propogate_one_frame(
+                    img, img_embs=img_embs)
+                self.group_outputs.append(None)
+            else:
+                engines = [self.aot_engines[idx] for idx in group]
+                if img_embs is None:
+                    img_embs, _ = engines[0].encode_one_img_mask(
+                        img, None, engines[0].frame_step + 1)
+                self.group_outputs.append(
+                    match_propogate_engines(self.AOT, engines, img_embs,
+                                            self.stacked_long_term_memories))
             if img_embs is None:  # reuse image embeddings
-                img_embs = aot_engine.curr_enc_embs
+                img_embs = self.aot_engines[group[0]].curr_enc_embs
+        release_stacked_memories(
+            self.stacked_long_term_memories,
+            [[self.aot_engines[idx] for idx in group]
+             for group in self.engine_groups])
 
     def decode_current_logits(self, output_size=None):
-        all_logits = []
-        for aot_engine in self.aot_engines:
-            all_logits.append(aot_engine.decode_current_logits(output_size))
+        all_logits = [None] * len(self.aot_engines)
+        for group, group_output in zip(self.engine_groups,
+                                       self.group_outputs):
+            if group_output is None:
+                for idx in group:
+                    all_logits[idx] = self.aot_engines[
+                        idx].decode_current_logits(output_size)
+                continue
+
+            engines = [self.aot_engines[idx] for idx in group]
+            group_logits = decode_engines(self.AOT, engines, *group_output)
+            if output_size is not None:
+                group_logits = F.interpolate(
+                    group_logits,
+                    size=output_size,
+                    mode="bilinear",
+                    align_corners=engines[0].align_corners)
+            for group_idx, idx in enumerate(group):
+                all_logits[idx] = group_logits.narrow(0, group_idx, 1)
         pred_id_logits = self.soft_logit_aggregation(all_logits)
         return pred_id_logits
 
@@ -12,9 +12,13 @@ class DeAOTEngine(AOTEngine):
                  gpu_id=0,
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
-                 layer_loss_scaling_ratio=2.):
+                 layer_loss_scaling_ratio=2.,
+                 max_long_term_mem=-1,
+                 long_term_mem_policy='recent',
+                 long_term_mem_dtype=None):
         super().__init__(aot_model, gpu_id, long_term_mem_gap,
-                         short_term_mem_skip)
+                         short_term_mem_skip, max_long_term_mem,
+                         long_term_mem_policy, long_term_mem_dtype)
         self.layer_loss_scaling_ratio = layer_loss_scaling_ratio
 
     def update_short_term_memory(self, curr_mask, curr_id_emb=None, skip_long_term_update=False):
@@ -62,9 +66,23 @@ class DeAOTInferEngine(AOTInferEngine):
                  gpu_id=0,
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
-                 max_aot_obj_num=None):
+                 max_aot_obj_num=None,
+                 max_long_term_mem=-1,
+                 long_term_mem_policy='recent',
+                 long_term_mem_dtype=None):
         super().__init__(aot_model, gpu_id, long_term_mem_gap,
-                         short_term_mem_skip, max_aot_obj_num)
+                         short_term_mem_skip, max_aot_obj_num,
+                         max_long_term_mem, long_term_mem_policy,
+                         long_term_mem_dtype)
+
+    def build_sub_engine(self):
+        return DeAOTEngine(self.AOT,
+                           self.gpu_id,
+                           self.long_term_mem_gap,
+                           self.short_term_mem_skip,
+                           max_long_term_mem=self.max_long_term_mem,
+                           long_term_mem_policy=self.long_term_mem_policy,
+                           long_term_mem_dtype=self.long_term_mem_dtype)
 
     def add_reference_frame(self, img, mask, obj_nums, frame_step=-1):
         if isinstance(obj_nums, list):
@@ -72,9 +90,7 @@ class DeAOTInferEngine(AOTInferEngine):
         self.obj_nums = obj_nums
         aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
         while (aot_num > len(self.aot_engines)):
-            new_engine = DeAOTEngine(self.AOT, self.gpu_id,
-                                     self.long_term_mem_gap,
-                                     self.short_term_mem_skip)
+            new_engine = self.build_sub_engine()
             new_engine.eval()
             self.aot_engines.append(new_engine)
 
@@ -94,4 +110,5 @@ class DeAOTInferEngine(AOTInferEngine):
             if img_embs is None:  # reuse image embeddings
                 img_embs = aot_engine.curr_enc_embs
 
+        self.ungroup_engines()
         self.update_size()
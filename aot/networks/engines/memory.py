@@ -0,0 +1,321 @@
+import copy
+
+import torch
+
+from networks.layers.basic import QuantizedSequence
+
+
+def memories_require_grad(memories):
+    for layer_memories in memories:
+        for e in layer_memories:
+            if e is not None and e.requires_grad:
+                return True
+    return False
+
+
+def stack_memories(memories_list, dim):
+    # memories of several engines, stacked along their batch dimension
+    stacked = []
+    for layer_memories in zip(*memories_list):
+        stacked.append([
+            None if e[0] is None else QuantizedSequence.cat(e, dim=dim)
+            if isinstance(e[0], QuantizedSequence) else torch.cat(e, dim=dim)
+            for e in zip(*layer_memories)
+        ])
+    return stacked
+
+
+def select_memories(memories, idx, dim):
+    return [[
+        None if e is None else e.narrow(dim, idx, 1) for e in layer_memories
+    ] for layer_memories in memories]
+
+
+# storage dtypes of the long-term memories, None keeps the compute dtype.
+# int8 memories are quantized per frame and channel.
+STORAGE_DTYPES = {
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int8': torch.int8,
+}
+
+
+def quantize(e):
+    # symmetric int8 quantization, one scale per batch and channel
+    scale = e.abs().amax(dim=0).float().clamp(min=1e-8) / 127.
+    return torch.round(e.float() / scale).clamp(-127, 127), scale
+
+
+def recent_scores(memory):
+    # evict the oldest frame
+    return memory.steps.float()
+
+
+def confidence_scores(memory):
+    # evict the frame with the least confident prediction
+    return memory.confidence
+
+
+def usage_scores(memory):
+    # evict the frame that received the least attention per propagated frame
+    return memory.usage / memory.age.clamp(min=1).to(memory.usage)
+
+
+# eviction policies score the stored frames, the unpinned frame with the
+# lowest score is replaced
+EVICTION_POLICIES = {
+    'recent': recent_scores,
+    'confidence': confidence_scores,
+    'usage': usage_scores,
+}
+
+
+# per-slot statistics of LongTermMemory
+SLOT_STATS = ('pinned', 'steps', 'age', 'confidence', 'usage')
+
+
+class LongTermMemory(object):
+    """
+    Long-term memories of an engine, kept in buffers preallocated per layer.
+
+    Each memory frame is a list (one per LSTT layer) of sequence tensors
+    [HW, B, C] (K, V, and for DeAOT the ID tensors, which may be None).
+    Frames are written in place into slots of buffers of shape
+    [capacity * HW, B, C]; the LSTT attends to views of the valid slots,
+    so adding a frame copies only that frame instead of the whole memory.
+    When the buffers are full the capacity is doubled, up to max_frames.
+
+    With max_frames > 0, a new frame replaces the unpinned frame chosen by
+    the eviction policy once max_frames frames are stored, so the attention
+    cost stays constant. Reference frames are pinned and never evicted.
+
+    With dtype ('float16', 'bfloat16' or 'int8') the buffers are stored in a
+    lower precision and the attention layers cast them back when they read
+    them. int8 frames keep a scale per channel in scale buffers of shape
+    [capacity, B, C], and their views are QuantizedSequence.
+
+    fork() returns a copy that shares the buffers until one of them writes
+    a frame, which then copies the buffers first.
+    """
+    def __init__(self,
+                 memories,
+                 capacity=1,
+                 max_frames=-1,
+                 policy='recent',
+                 dtype=None):
+        # number of memories sharing the buffers, see fork()
+        self.buffer_refs = [1]
+        if policy not in EVICTION_POLICIES:
+            raise NotImplementedError
+        if dtype is not None and dtype not in STORAGE_DTYPES:
+            raise NotImplementedError
+        self.max_frames = max_frames
+        self.policy = policy
+        self.dtype = dtype
+        self.quantized = dtype == 'int8'
+        if max_frames > 0:
+            capacity = min(capacity, max_frames)
+        self.capacity = max(int(capacity), 1)
+        self.frame_len = None
+        self.num_frames = 0
+        self.step = 0
+        self.buffers = []
+        self.scales = []
+        device = None
+        for layer_memories in memories:
+            layer_buffers = []
+            layer_scales = []
+            for e in layer_memories:
+                if e is None:
+                    layer_buffers.append(None)
+                    layer_scales.append(None)
+                    continue
+                if self.frame_len is None:
+                    self.frame_len = e.size(0)
+                    device = e.device
+                layer_buffers.append(
+                    e.new_empty((self.capacity * self.frame_len, ) +
+                                tuple(e.size()[1:]),
+                                dtype=STORAGE_DTYPES.get(dtype, e.dtype)))
+                layer_scales.append(
+                    e.new_empty((self.capacity, ) + tuple(e.size()[1:]),
+                                dtype=torch.float32
+                                ) if self.quantized else None)
+            self.buffers.append(layer_buffers)
+            self.scales.append(layer_scales)
+
+        # per-slot statistics for the eviction policies
+        self.pinned = torch.zeros(self.capacity, dtype=torch.bool)
+        self.steps = torch.zeros(self.capacity, dtype=torch.long)
+        self.age = torch.zeros(self.capacity, dtype=torch.long)
+        self.confidence = torch.ones(self.capacity, device=device)
+        self.usage = torch.zeros(self.capacity, device=device)
+
+        self.append(memories, pinned=True)
+
+    def append(self, memories, pinned=False, confidence=1.):
+        slot = None
+        if self.num_frames == self.capacity:
+            if self.max_frames > 0 and self.num_frames >= self.max_frames:
+                slot = self.evict_slot()
+            if slot is None:  # unbounded, or only pinned frames are stored
+                capacity = self.capacity * 2
+                if self.capacity < self.max_frames:
+                    capacity = min(capacity, self.max_frames)
+                self._grow(capacity)
+        if slot is None:
+            slot = self.num_frames
+            self.num_frames += 1
+
+        self._write(slot, memories)
+        self.pinned[slot] = pinned
+        self.steps[slot] = self.step
+        self.age[slot] = 0
+        self.confidence[slot] = confidence
+        self.usage[slot] = 0
+        self.step += 1
+
+    def fork(self):
+        forked = copy.copy(self)
+        forked.buffers = [list(layer) for layer in self.buffers]
+        forked.scales = [list(layer) for layer in self.scales]
+        self.buffer_refs[0] += 1
+        for name in SLOT_STATS:
+            setattr(forked, name, getattr(self, name).clone())
+        return forked
+
+    def state_dict(self):
+        # valid frames only, without the free capacity
+        length = self.num_frames * self.frame_len
+        return {
+            'max_frames': self.max_frames,
+            'policy': self.policy,
+            'dtype': self.dtype,
+            'frame_len': self.frame_len,
+            'num_frames': self.num_frames,
+            'step': self.step,
+            'buffers': [[None if buf is None else buf[:length].clone()
+                         for buf in layer] for layer in self.buffers],
+            'scales': [[
+                None if scale is None else scale[:self.num_frames].clone()
+                for scale in layer
+            ] for layer in self.scales],
+            'stats': {
+                name: getattr(self, name)[:self.num_frames].clone()
+                for name in SLOT_STATS
+            },
+        }
+
+    @classmethod
+    def from_state_dict(cls, state):
+        memory = cls.__new__(cls)
+        for name in [
+                'max_frames', 'policy', 'dtype', 'frame_len', 'num_frames',
+                'step', 'buffers', 'scales'
+        ]:
+            setattr(memory, name, state[name])
+        for name, stat in state['stats'].items():
+            setattr(memory, name, stat)
+        memory.quantized = memory.dtype == 'int8'
+        memory.capacity = memory.num_frames
+        memory.buffer_refs = [1]
+        return memory
+
+    def evict_slot(self):
+        unpinned = ~self.pinned[:self.num_frames]
+        if not unpinned.any():
+            return None
+        scores = EVICTION_POLICIES[self.policy](self)[:self.num_frames]
+        scores = scores.cpu().masked_fill(~unpinned, float('inf'))
+        return int(torch.argmin(scores))
+
+    def record_usage(self, attn_usages):
+        """
+        attn_usages: one tensor [B, T_k] per layer, the attention received by
+            each long-term memory token in the last propagation
+        """
+        num_frames = self.num_frames
+        usage = 0
+        for attn_usage in attn_usages:
+            usage = usage + attn_usage.view(-1, num_frames,
+                                            self.frame_len).sum(dim=(0, 2))
+        # share of the attention relative to an even split, so that frames
+        # stored while the memory was smaller are not favored
+        usage = usage * num_frames / usage.sum().clamp(min=1e-8)
+        self.usage[:num_frames] += usage
+        self.age[:num_frames] += 1
+
+    def views(self):
+        length = self.num_frames * self.frame_len
+        if self.quantized:
+            return [[
+                None if buf is None else QuantizedSequence(
+                    buf[:length], scale[:self.num_frames], self.frame_len)
+                for buf, scale in zip(layer_buffers, layer_scales)
+            ] for layer_buffers, layer_scales in zip(self.buffers, self.scales)]
+        return [[buf[:length] if buf is not None else None for buf in layer]
+                for layer in self.buffers]
+
+    def _write(self, slot, memories):
+        self._own_buffers()
+        start = slot * self.frame_len
+        for layer_buffers, layer_scales, layer_memories in zip(
+                self.buffers, self.scales, memories):
+            for buf, scale, e in zip(layer_buffers, layer_scales,
+                                     layer_memories):
+                if buf is None or e is None:
+                    continue
+                if e.size(0) != self.frame_len:
+                    raise ValueError(
+                        'Long-term memory frames must have {} tokens, got {}.'.
+                        format(self.frame_len, e.size(0)))
+                if scale is not None:
+                    e, scale[slot] = quantize(e)
+                buf[start:start + self.frame_len].copy_(e)
+
+    def _grow(self, capacity):
+        length = self.num_frames * self.frame_len
+        for layer_buffers, layer_scales in zip(self.buffers, self.scales):
+            for idx, buf in enumerate(layer_buffers):
+                if buf is None:
+                    continue
+                new_buf = buf.new_empty((capacity * self.frame_len, ) +
+                                        tuple(buf.size()[1:]))
+                new_buf[:length].copy_(buf[:length])
+                layer_buffers[idx] = new_buf
+                scale = layer_scales[idx]
+                if scale is not None:
+                    new_scale = scale.new_empty((capacity, ) +
+                                                tuple(scale.size()[1:]))
+                    new_scale[:self.num_frames].copy_(
+                        scale[:self.num_frames])
+                    layer_scales[idx] = new_scale
+
+        def grow_stat(stat, value):
+            new_stat = stat.new_full((capacity, ), value)
+            new_stat[:self.capacity] = stat
+            return new_stat
+
+        self.pinned = grow_stat(self.pinned, False)
+        self.steps = grow_stat(self.steps, 0)
+        self.age = grow_stat(self.age, 0)
+        self.confidence = grow_stat(self.confidence, 1.)
+        self.usage = grow_stat(self.usage, 0.)
+        self.capacity = capacity
+        self._own_buffers(copy_buffers=False)
+
+    def _own_buffers(self, copy_buffers=True):
+        # copy on write of buffers shared with forks
+        if self.buffer_refs[0] == 1:
+            return
+        self.buffer_refs[0] -= 1
+        self.buffer_refs = [1]
+        if not copy_buffers:
+            return
+        for layer in self.buffers + self.scales:
+            for idx, buf in enumerate(layer):
+                if buf is not None:
+                    layer[idx] = buf.clone()
+
+    def __del__(self):
+        self.buffer_refs[0] -= 1
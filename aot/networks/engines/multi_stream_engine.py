@@ -0,0 +1,154 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from networks.engines.aot_engine import group_engines, match_propogate_engines, \
+    decode_engines, release_stacked_memories
+
+
+class MultiStreamInferEngine(nn.Module):
+    """
+    Tracks several independent videos (streams) in lockstep. Every stream
+    has its own AOTInferEngine / DeAOTInferEngine holding its memories, so
+    reference frames, memory updates and restarts stay per stream, while
+    each propagation step runs one batched encoder pass per resolution and
+    one batched LSTT and decoder pass for all sub-engines whose memories
+    have the same size. Streams can be added and removed between steps.
+    """
+    def __init__(self, aot_model, build_stream_engine):
+        """
+        build_stream_engine: returns a new inference engine of aot_model,
+            e.g. lambda: build_engine('deaotengine', 'eval', aot_model=model)
+        """
+        super().__init__()
+        self.AOT = aot_model
+        self.build_stream_engine = build_stream_engine
+        self.streams = {}
+        self.restart_engine()
+
+    def restart_engine(self):
+        self.streams.clear()
+        self.frame_groups = []
+        self.stacked_long_term_memories = {}
+
+    def add_stream(self, stream_id):
+        engine = self.build_stream_engine()
+        engine.eval()
+        self.streams[stream_id] = engine
+        return engine
+
+    def remove_stream(self, stream_id):
+        del self.streams[stream_id]
+
+    def restart_stream(self, stream_id):
+        self.streams[stream_id].restart_engine()
+
+    def snapshot_stream(self, stream_id):
+        return self.streams[stream_id].snapshot()
+
+    def restore_stream(self, stream_id, snapshot):
+        if stream_id not in self.streams:
+            self.add_stream(stream_id)
+        self.streams[stream_id].restore(snapshot)
+
+    def add_reference_frame(self,
+                            stream_id,
+                            img,
+                            mask,
+                            obj_nums,
+                            frame_step=-1):
+        if stream_id not in self.streams:
+            self.add_stream(stream_id)
+        self.streams[stream_id].add_reference_frame(img, mask, obj_nums,
+                                                    frame_step)
+
+    def match_propogate_one_frame(self, imgs):
+        """
+        imgs: dict of stream id -> current frame [1, 3, H, W]. Streams that
+            are left out do not advance.
+        """
+        self.frame_groups = []
+
+        # frames of the same size are encoded as one batch
+        buckets = {}
+        for stream_id, img in imgs.items():
+            buckets.setdefault(tuple(img.size()[-2:]), []).append(stream_id)
+
+        for stream_ids in buckets.values():
+            img_embs = self.AOT.encode_image(
+                torch.cat([imgs[stream_id] for stream_id in stream_ids],
+                          dim=0))
+            engines, rows = [], []
+            for row, stream_id in enumerate(stream_ids):
+                for aot_engine in self.streams[stream_id].aot_engines:
+                    engines.append(aot_engine)
+                    rows.append(row)
+
+            for group in group_engines(engines):
+                members = [engines[idx] for idx in group]
+                group_rows = [rows[idx] for idx in group]
+                if len(group) == 1:
+                    row = group_rows[0]
+                    members[0].match_propogate_one_frame(
+                        img_embs=[emb.narrow(0, row, 1) for emb in img_embs])
+                    self.frame_groups.append((members, None))
+                    continue
+                if len(set(group_rows)) == 1:
+                    img_index = None
+                    group_embs = [
+                        emb.narrow(0, group_rows[0], 1) for emb in img_embs
+                    ]
+                else:
+                    img_index = torch.tensor(group_rows,
+                                             device=img_embs[-1].device)
+                    group_embs = img_embs
+                output = match_propogate_engines(
+                    self.AOT, members, group_embs,
+                    self.stacked_long_term_memories, img_index)
+                self.frame_groups.append((members, output))
+
+        release_stacked_memories(
+            self.stacked_long_term_memories,
+            [members for members, _ in self.frame_groups])
+
+    def decode_current_logits(self, output_sizes=None):
+        """
+        output_sizes: dict of stream id -> (H, W) of the returned logits
+        Returns a dict of stream id -> merged logits of the stream.
+        """
+        engine_logits = {}
+        for members, output in self.frame_groups:
+            if output is None:
+                engine_logits[id(
+                    members[0])] = members[0].decode_current_logits()
+                continue
+            group_logits = decode_engines(self.AOT, members, *output)
+            for idx, aot_engine in enumerate(members):
+                engine_logits[id(aot_engine)] = group_logits.narrow(0, idx, 1)
+
+        all_logits = {}
+        for stream_id, stream in self.streams.items():
+            if len(stream.aot_engines) == 0 or id(
+                    stream.aot_engines[0]) not in engine_logits:
+                continue
+            logits = torch.cat([
+                engine_logits[id(aot_engine)]
+                for aot_engine in stream.aot_engines
+            ], dim=0)
+            if output_sizes is not None and stream_id in output_sizes:
+                logits = F.interpolate(
+                    logits,
+                    size=output_sizes[stream_id],
+                    mode="bilinear",
+                    align_corners=stream.aot_engines[0].align_corners)
+            all_logits[stream_id] = stream.soft_logit_aggregation(
+                list(torch.split(logits, 1, dim=0)))
+        return all_logits
+
+    def update_memory(self, curr_masks, skip_long_term_update=False):
+        """
+        curr_masks: dict of stream id -> predicted label [1, 1, H, W]
+        """
+        for stream_id, curr_mask in curr_masks.items():
+            self.streams[stream_id].update_memory(
+                curr_mask, skip_long_term_update=skip_long_term_update)
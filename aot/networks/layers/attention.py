@@ -2,7 +2,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from networks.layers.basic import DropOutLogit, ScaleOffset, DWConv2d
+from networks.layers.basic import DropOutLogit, ScaleOffset, DWConv2d, dequantize
 
 
 def multiply_by_ychunks(x, y, chunks=1):
@@ -19,6 +19,69 @@ def multiply_by_xchunks(x, y, chunks=1):
         return torch.cat([_x @ y for _x in x.chunk(chunks, dim=-2)], dim=-2)
 
 
+class ShiftedWindowCorrelation(nn.Module):
+    """
+    Pure PyTorch counterpart of SpatialCorrelationSampler(kernel_size=1,
+    patch_size=window_size, dilation_patch=dilation), used when the
+    spatial_correlation_sampler extension is not installed. The window is
+    visited one offset at a time on shifted views of the padded keys, so no
+    unfolded [window_size^2 * C, HW] tensor is built.
+    """
+    def __init__(self, window_size, dilation=1):
+        super().__init__()
+        self.window_size = window_size
+        self.dilation = dilation
+
+    def forward(self, q, k):
+        n, c, h, w = q.size()
+        pad_pixel = (self.window_size // 2) * self.dilation
+        k = F.pad(k, (pad_pixel, pad_pixel, pad_pixel, pad_pixel),
+                  mode='constant',
+                  value=0)
+        qk = q.new_empty((n, self.window_size, self.window_size, h, w))
+        for y in range(self.window_size):
+            dy = y * self.dilation
+            for x in range(self.window_size):
+                dx = x * self.dilation
+                qk[:, y, x] = (q * k[:, :, dy:dy + h, dx:dx + w]).sum(dim=1)
+        return qk
+
+
+def build_correlation_sampler(window_size, dilation=1):
+    try:
+        from spatial_correlation_sampler import SpatialCorrelationSampler
+    except ImportError:
+        print("Failed to import PyTorch Correlation, "
+              "falling back to shifted-window local attention.")
+        return ShiftedWindowCorrelation(window_size, dilation)
+    return SpatialCorrelationSampler(kernel_size=1,
+                                     patch_size=window_size,
+                                     stride=1,
+                                     padding=0,
+                                     dilation=1,
+                                     dilation_patch=dilation)
+
+
+def shifted_window_aggregation(local_attn, v, window_size, dilation=1):
+    """
+    Sums the windows of v weighted by local_attn, i.e. local2global(local_attn)
+    @ v without the dense [HW, HW] attention or unfolded values.
+    local_attn: [N, window_size^2, H, W], v: [N, C, H, W] -> [N, C, H, W]
+    """
+    n, c, h, w = v.size()
+    pad_pixel = (window_size // 2) * dilation
+    v = F.pad(v, (pad_pixel, pad_pixel, pad_pixel, pad_pixel),
+              mode='constant',
+              value=0)
+    output = v.new_zeros((n, c, h, w))
+    for idx in range(window_size * window_size):
+        dy = (idx // window_size) * dilation
+        dx = (idx % window_size) * dilation
+        output.addcmul_(local_attn[:, idx:idx + 1], v[:, :, dy:dy + h,
+                                                      dx:dx + w])
+    return output
+
+
 # Long-term attention
 class MultiheadAttention(nn.Module):
     def __init__(self,
@@ -65,6 +128,10 @@ class MultiheadAttention(nn.Module):
 
         bs = Q.size()[1]
 
+        # memories stored in a lower precision
+        K = dequantize(K, Q.dtype)
+        V = dequantize(V, Q.dtype)
+
         # Linear projections
         if self.use_linear:
             Q = self.linear_Q(Q)
@@ -155,15 +222,12 @@ class MultiheadLocalAttentionV1(nn.Module):
 
         self.enable_corr = enable_corr
 
+        self.shifted_window = False
         if enable_corr:
-            from spatial_correlation_sampler import SpatialCorrelationSampler
-            self.correlation_sampler = SpatialCorrelationSampler(
-                kernel_size=1,
-                patch_size=self.window_size,
-                stride=1,
-                padding=0,
-                dilation=1,
-                dilation_patch=self.dilation)
+            self.correlation_sampler = build_correlation_sampler(
+                self.window_size, self.dilation)
+            self.shifted_window = isinstance(self.correlation_sampler,
+                                             ShiftedWindowCorrelation)
 
         self.projection = nn.Linear(d_model, d_model)
 
@@ -188,14 +252,16 @@ class MultiheadLocalAttentionV1(nn.Module):
 
         q = q.view(-1, hidden_dim, h, w)
         k = k.reshape(-1, hidden_dim, h, w).contiguous()
-        unfolded_vu = self.pad_and_unfold(v).view(
-            n, self.num_head, hidden_dim, self.window_size * self.window_size,
-            h * w) + self.relative_emb_v.unsqueeze(0).unsqueeze(-1)
+        if not self.shifted_window:
+            unfolded_vu = self.pad_and_unfold(v).view(
+                n, self.num_head, hidden_dim,
+                self.window_size * self.window_size,
+                h * w) + self.relative_emb_v.unsqueeze(0).unsqueeze(-1)
 
         relative_emb = relative_emb.view(n, self.num_head,
                                          self.window_size * self.window_size,
                                          h * w)
-        unfolded_k_mask = self.pad_and_unfold(memory_mask).bool().view(
+        unfolded_k_mask = self.pad_and_unfold(memory_mask).view(
             1, 1, self.window_size * self.window_size,
             h * w).expand(n, self.num_head, -1, -1)
 
@@ -219,8 +285,16 @@ class MultiheadLocalAttentionV1(nn.Module):
 
         local_attn = self.dropout(local_attn)
 
-        output = (local_attn.unsqueeze(2) * unfolded_vu).sum(dim=3).permute(
-            3, 0, 1, 2).view(h * w, n, c)
+        if self.shifted_window:
+            output = shifted_window_aggregation(
+                local_attn.view(-1, self.window_size * self.window_size, h, w),
+                v.view(-1, hidden_dim, h, w), self.window_size,
+                self.dilation).view(n, self.num_head, hidden_dim, h * w)
+            output = output + torch.einsum('bhwn,hcw->bhcn', local_attn,
+                                           self.relative_emb_v)
+        else:
+            output = (local_attn.unsqueeze(2) * unfolded_vu).sum(dim=3)
+        output = output.permute(3, 0, 1, 2).reshape(h * w, n, c)
 
         output = self.projection(output)
 
@@ -278,15 +352,12 @@ class MultiheadLocalAttentionV2(nn.Module):
 
         self.enable_corr = enable_corr
 
+        self.shifted_window = False
         if enable_corr:
-            from spatial_correlation_sampler import SpatialCorrelationSampler
-            self.correlation_sampler = SpatialCorrelationSampler(
-                kernel_size=1,
-                patch_size=self.window_size,
-                stride=1,
-                padding=0,
-                dilation=1,
-                dilation_patch=self.dilation)
+            self.correlation_sampler = build_correlation_sampler(
+                self.window_size, self.dilation)
+            self.shifted_window = isinstance(self.correlation_sampler,
+                                             ShiftedWindowCorrelation)
 
         self.projection = nn.Linear(d_model, d_model)
 
@@ -335,7 +406,7 @@ class MultiheadLocalAttentionV2(nn.Module):
                 n, self.num_head, self.window_size * self.window_size, h * w)
         else:
             unfolded_k = self.pad_and_unfold(k).view(
-                n * self.num_head, hidden_dim,
+                n * self.num_head, self.d_att,
                 self.window_size * self.window_size, h, w)
             qk = (q.unsqueeze(2) * unfolded_k).sum(dim=1).view(
                 n, self.num_head, self.window_size * self.window_size, h * w)
@@ -356,9 +427,7 @@ class MultiheadLocalAttentionV2(nn.Module):
         agg_bias = torch.einsum('bhwn,hcw->bhnc', local_attn,
                                 self.relative_emb_v)
 
-        global_attn = self.local2global(local_attn, h, w)
-
-        agg_value = (global_attn @ v.transpose(-2, -1))
+        agg_value = self.aggregate(local_attn, v, h, w)
 
         output = (agg_value + agg_bias).permute(2, 0, 1,
                                                 3).reshape(h * w, n, c)
@@ -368,6 +437,19 @@ class MultiheadLocalAttentionV2(nn.Module):
         self.last_size_2d = (h, w)
         return output, local_attn
 
+    def aggregate(self, local_attn, v, height, width):
+        # local_attn: [N, head, window^2, HW], v: [N, head, C, HW]
+        # -> [N, head, HW, C]
+        if self.shifted_window:
+            agg_value = shifted_window_aggregation(
+                local_attn.view(-1, self.window_size * self.window_size,
+                                height, width),
+                v.reshape(-1, v.size(2), height, width), self.window_size,
+                self.dilation)
+            return agg_value.view(v.size()).transpose(-2, -1)
+        global_attn = self.local2global(local_attn, height, width)
+        return global_attn @ v.transpose(-2, -1)
+
     def local2global(self, local_attn, height, width):
         batch_size = local_attn.size()[0]
 
@@ -636,6 +718,10 @@ class GatedPropagation(nn.Module):
 
         l, bs, _ = Q.size()
 
+        # memories stored in a lower precision
+        K = dequantize(K, Q.dtype)
+        V = dequantize(V, Q.dtype)
+
         # Linear projections
         if self.use_linear:
             Q = K = self.linear_QK(Q)
@@ -757,15 +843,12 @@ class LocalGatedPropagation(nn.Module):
 
         self.enable_corr = enable_corr
 
+        self.shifted_window = False
         if enable_corr:
-            from spatial_correlation_sampler import SpatialCorrelationSampler
-            self.correlation_sampler = SpatialCorrelationSampler(
-                kernel_size=1,
-                patch_size=self.window_size,
-                stride=1,
-                padding=0,
-                dilation=1,
-                dilation_patch=self.dilation)
+            self.correlation_sampler = build_correlation_sampler(
+                self.window_size, self.dilation)
+            self.shifted_window = isinstance(self.correlation_sampler,
+                                             ShiftedWindowCorrelation)
 
         self.dw_conv = DWConv2d(self.expand_d_vu)
         self.projection = nn.Linear(self.expand_d_vu, d_vu)
@@ -821,7 +904,7 @@ class LocalGatedPropagation(nn.Module):
                 n, self.num_head, self.window_size * self.window_size, h * w)
         else:
             unfolded_k = self.pad_and_unfold(k).view(
-                n * self.num_head, hidden_dim,
+                n * self.num_head, self.d_att,
                 self.window_size * self.window_size, h, w)
             qk = (q.unsqueeze(2) * unfolded_k).sum(dim=1).view(
                 n, self.num_head, self.window_size * self.window_size, h * w)
@@ -839,10 +922,9 @@ class LocalGatedPropagation(nn.Module):
 
         local_attn = self.dropout(local_attn)
 
-        global_attn = self.local2global(local_attn, h, w)
-
-        agg_value = (global_attn @ v.transpose(-2, -1)).permute(
-            2, 0, 1, 3).reshape(h * w, n, -1)
+        agg_value = self.aggregate(local_attn, v, h,
+                                   w).permute(2, 0, 1,
+                                              3).reshape(h * w, n, -1)
 
         output = agg_value * u
 
@@ -852,6 +934,19 @@ class LocalGatedPropagation(nn.Module):
         self.last_size_2d = (h, w)
         return output, local_attn
 
+    def aggregate(self, local_attn, v, height, width):
+        # local_attn: [N, head, window^2, HW], v: [N, head, C, HW]
+        # -> [N, head, HW, C]
+        if self.shifted_window:
+            agg_value = shifted_window_aggregation(
+                local_attn.view(-1, self.window_size * self.window_size,
+                                height, width),
+                v.reshape(-1, v.size(2), height, width), self.window_size,
+                self.dilation)
+            return agg_value.view(v.size()).transpose(-2, -1)
+        global_attn = self.local2global(local_attn, height, width)
+        return global_attn @ v.transpose(-2, -1)
+
     def local2global(self, local_attn, height, width):
         batch_size = local_attn.size()[0]
 
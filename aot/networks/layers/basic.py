@@ -92,6 +92,50 @@ def seq_to_2d(tensor, size_2d):
     return tensor
 
 
+class QuantizedSequence(object):
+    """
+    int8 sequence [T, B, C] made of blocks of block_len tokens, each block
+    with its own per-channel scale [B, C]; see LongTermMemory in
+    networks/engines/memory.py.
+    """
+    def __init__(self, data, scale, block_len):
+        self.data = data
+        self.scale = scale
+        self.block_len = block_len
+
+    def size(self, dim=None):
+        return self.data.size() if dim is None else self.data.size(dim)
+
+    def narrow(self, dim, start, length):
+        # along the batch or channel dimension
+        return QuantizedSequence(self.data.narrow(dim, start, length),
+                                 self.scale.narrow(dim, start, length),
+                                 self.block_len)
+
+    @staticmethod
+    def cat(sequences, dim):
+        return QuantizedSequence(torch.cat([e.data for e in sequences], dim),
+                                 torch.cat([e.scale for e in sequences], dim),
+                                 sequences[0].block_len)
+
+    def dequantize(self, dtype):
+        num_blocks = self.data.size(0) // self.block_len
+        data = self.data.view((num_blocks, self.block_len) +
+                              tuple(self.data.size()[1:])).to(dtype)
+        scale = self.scale.view((num_blocks, 1) +
+                                tuple(self.scale.size()[1:])).to(dtype)
+        return (data * scale).view(self.data.size())
+
+
+def dequantize(x, dtype):
+    # memories may be stored in a lower precision than they are computed in
+    if isinstance(x, QuantizedSequence):
+        return x.dequantize(dtype)
+    if x is None or x.dtype == dtype:
+        return x
+    return x.to(dtype)
+
+
 def drop_path(x, drop_prob: float = 0., training: bool = False):
     if drop_prob == 0. or not training:
         return x
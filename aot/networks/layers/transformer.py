@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
-from networks.layers.basic import DropPath, GroupNorm1D, GNActDWConv2d, seq_to_2d, ScaleOffset, mask_out
+from networks.layers.basic import DropPath, GroupNorm1D, GNActDWConv2d, seq_to_2d, ScaleOffset, mask_out, dequantize
 from networks.layers.attention import silu, MultiheadAttention, MultiheadLocalAttentionV2, MultiheadLocalAttentionV3, GatedPropagation, LocalGatedPropagation
 
 
@@ -93,7 +93,8 @@ class LongShortTermTransformer(nn.Module):
                 short_term_memories,
                 curr_id_emb=None,
                 self_pos=None,
-                size_2d=None):
+                size_2d=None,
+                long_term_attn_usage=None):
 
         output = self.emb_dropout(tgt)
 
@@ -110,7 +111,8 @@ class LongShortTermTransformer(nn.Module):
                                      short_term_memories is not None else None,
                                      curr_id_emb=curr_id_emb,
                                      self_pos=self_pos,
-                                     size_2d=size_2d)
+                                     size_2d=size_2d,
+                                     long_term_attn_usage=long_term_attn_usage)
 
             if self.return_intermediate:
                 intermediate.append(output)
@@ -203,7 +205,8 @@ class DualBranchGPM(nn.Module):
                 short_term_memories,
                 curr_id_emb=None,
                 self_pos=None,
-                size_2d=None):
+                size_2d=None,
+                long_term_attn_usage=None):
 
         output = self.emb_dropout(tgt)
 
@@ -223,7 +226,8 @@ class DualBranchGPM(nn.Module):
                 if short_term_memories is not None else None,
                 curr_id_emb=curr_id_emb,
                 self_pos=self_pos,
-                size_2d=size_2d)
+                size_2d=size_2d,
+                long_term_attn_usage=long_term_attn_usage)
 
             cat_output = torch.cat([output, output_id], dim=2)
 
@@ -275,17 +279,8 @@ class LongShortTermTransformerBlock(nn.Module):
                                                  use_linear=False,
                                                  dropout=lt_dropout)
 
-        # MultiheadLocalAttention = MultiheadLocalAttentionV2 if enable_corr else MultiheadLocalAttentionV3
-        if enable_corr:
-            try:
-                import spatial_correlation_sampler
-                MultiheadLocalAttention = MultiheadLocalAttentionV2
-            except Exception as inst:
-                print(inst)
-                print("Failed to import PyTorch Correlation, For better efficiency, please install it.")
-                MultiheadLocalAttention = MultiheadLocalAttentionV3
-        else:
-            MultiheadLocalAttention = MultiheadLocalAttentionV3
+        # without spatial_correlation_sampler, V2 falls back to shifted windows
+        MultiheadLocalAttention = MultiheadLocalAttentionV2 if enable_corr else MultiheadLocalAttentionV3
         self.short_term_attn = MultiheadLocalAttention(d_model,
                                                        att_nhead,
                                                        dilation=local_dilation,
@@ -320,7 +315,8 @@ class LongShortTermTransformerBlock(nn.Module):
                 short_term_memory=None,
                 curr_id_emb=None,
                 self_pos=None,
-                size_2d=(30, 30)):
+                size_2d=(30, 30),
+                long_term_attn_usage=None):
 
         # Self-attention
         _tgt = self.norm1(tgt)
@@ -348,7 +344,10 @@ class LongShortTermTransformerBlock(nn.Module):
             global_K, global_V = long_term_memory
             local_K, local_V = short_term_memory
 
-        tgt2 = self.long_term_attn(curr_Q, global_K, global_V)[0]
+        tgt2, long_term_attn = self.long_term_attn(curr_Q, global_K, global_V)
+        if long_term_attn_usage is not None:
+            # attention received by each memory token, for memory eviction
+            long_term_attn_usage.append(long_term_attn.sum(dim=(1, 2)))
         tgt3 = self.short_term_attn(local_Q, local_K, local_V)[0]
 
         if self.droppath_lst:
@@ -408,17 +407,8 @@ class LongShortTermTransformerBlockV2(nn.Module):
                                                  use_linear=False,
                                                  dropout=lt_dropout)
 
-        # MultiheadLocalAttention = MultiheadLocalAttentionV2 if enable_corr else MultiheadLocalAttentionV3
-        if enable_corr:
-            try:
-                import spatial_correlation_sampler
-                MultiheadLocalAttention = MultiheadLocalAttentionV2
-            except Exception as inst:
-                print(inst)
-                print("Failed to import PyTorch Correlation, For better efficiency, please install it.")
-                MultiheadLocalAttention = MultiheadLocalAttentionV3
-        else:
-            MultiheadLocalAttention = MultiheadLocalAttentionV3
+        # without spatial_correlation_sampler, V2 falls back to shifted windows
+        MultiheadLocalAttention = MultiheadLocalAttentionV2 if enable_corr else MultiheadLocalAttentionV3
         self.short_term_attn = MultiheadLocalAttention(d_model,
                                                        att_nhead,
                                                        dilation=local_dilation,
@@ -449,7 +439,8 @@ class LongShortTermTransformerBlockV2(nn.Module):
                 short_term_memory=None,
                 curr_id_emb=None,
                 self_pos=None,
-                size_2d=(30, 30)):
+                size_2d=(30, 30),
+                long_term_attn_usage=None):
 
         # Self-attention
         _tgt = self.norm1(tgt)
@@ -479,7 +470,10 @@ class LongShortTermTransformerBlockV2(nn.Module):
             global_K, global_V = long_term_memory
             local_K, local_V = short_term_memory
 
-        tgt2 = self.long_term_attn(curr_Q, global_K, global_V)[0]
+        tgt2, long_term_attn = self.long_term_attn(curr_Q, global_K, global_V)
+        if long_term_attn_usage is not None:
+            # attention received by each memory token, for memory eviction
+            long_term_attn_usage.append(long_term_attn.sum(dim=(1, 2)))
         tgt3 = self.short_term_attn(local_Q, local_K, local_V)[0]
 
         if self.droppath_lst:
@@ -599,7 +593,8 @@ class GatedPropagationModule(nn.Module):
                 short_term_memory=None,
                 curr_id_emb=None,
                 self_pos=None,
-                size_2d=(30, 30)):
+                size_2d=(30, 30),
+                long_term_attn_usage=None):
 
         # Long Short-Term Attention
         _tgt = self.norm1(tgt)
@@ -635,11 +630,19 @@ class GatedPropagationModule(nn.Module):
             global_K, global_V, _, global_ID_V = long_term_memory
             local_K, local_V, _, local_ID_V = short_term_memory
 
-        cat_global_V = torch.cat([global_V, global_ID_V], dim=-1)
+        # memories stored in a lower precision
+        cat_global_V = torch.cat([
+            dequantize(global_V, curr_V.dtype),
+            dequantize(global_ID_V, curr_V.dtype)
+        ], dim=-1)
         cat_local_V = torch.cat([local_V, local_ID_V], dim=1)
 
-        cat_tgt2, _ = self.long_term_attn(curr_Q, global_K, cat_global_V,
-                                          cat_curr_U, size_2d)
+        cat_tgt2, long_term_attn = self.long_term_attn(curr_Q, global_K,
+                                                       cat_global_V,
+                                                       cat_curr_U, size_2d)
+        if long_term_attn_usage is not None:
+            # attention received by each memory token, for memory eviction
+            long_term_attn_usage.append(long_term_attn.sum(dim=(1, 2)))
         cat_tgt3, _ = self.short_term_attn(local_Q, local_K, cat_local_V,
                                            cat_curr_U, size_2d)
 
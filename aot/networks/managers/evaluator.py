@@ -16,7 +16,7 @@ from utils.image import flip_tensor, save_mask
 from utils.checkpoint import load_network
 from utils.eval import zip_folder
 
-from networks.models import build_vos_model
+from networks.models import build_vos_model, compile_vos_model
 from networks.engines import build_engine
 
 
@@ -103,8 +103,11 @@ class Evaluator(object):
         self.print_log('Process dataset...')
         eval_transforms = transforms.Compose([
             tr.MultiRestrictSize(cfg.TEST_MAX_SHORT_EDGE,
-                                 cfg.TEST_MAX_LONG_EDGE, cfg.TEST_FLIP,
-                                 cfg.TEST_MULTISCALE, cfg.MODEL_ALIGN_CORNERS),
+                                 cfg.TEST_MAX_LONG_EDGE,
+                                 cfg.TEST_FLIP,
+                                 cfg.TEST_MULTISCALE,
+                                 cfg.MODEL_ALIGN_CORNERS,
+                                 size_bucket=cfg.TEST_SIZE_BUCKET),
             tr.MultiToTensor()
         ])
 
@@ -206,6 +209,10 @@ class Evaluator(object):
     def evaluating(self):
         cfg = self.cfg
         self.model.eval()
+        if cfg.TEST_COMPILE:
+            compile_vos_model(
+                self.model,
+                mode=None if cfg.TEST_COMPILE is True else cfg.TEST_COMPILE)
         video_num = 0
         processed_video_num = 0
         total_time = 0
@@ -279,7 +286,13 @@ class Evaluator(object):
                                              long_term_mem_gap=self.cfg.
                                              TEST_LONG_TERM_MEM_GAP,
                                              short_term_mem_skip=self.cfg.
-                                             TEST_SHORT_TERM_MEM_SKIP))
+                                             TEST_SHORT_TERM_MEM_SKIP,
+                                             max_long_term_mem=self.cfg.
+                                             TEST_LONG_TERM_MEM_MAX,
+                                             long_term_mem_policy=self.cfg.
+                                             TEST_LONG_TERM_MEM_POLICY,
+                                             long_term_mem_dtype=self.cfg.
+                                             TEST_LONG_TERM_MEM_DTYPE))
                             all_engines[-1].eval()
 
                         if aug_num > 1:  # if use test-time augmentation
@@ -1,3 +1,5 @@
+import torch
+
 from networks.models.aot import AOT
 from networks.models.deaot import DeAOT
 
@@ -9,3 +11,26 @@ def build_vos_model(name, cfg, **kwargs):
         return DeAOT(cfg, encoder=cfg.MODEL_ENCODER, **kwargs)
     else:
         raise NotImplementedError
+
+
+def compile_vos_model(model, mode=None):
+    """
+    Compiles the per-frame inference passes of an AOT/DeAOT model with
+    torch.compile. The encoder and decoder graphs are specialized and cached
+    per input size, so frames should be resized to a few sizes (see
+    size_bucket of MultiRestrictSize); the LSTT keeps the memory length
+    dynamic since it changes with every long-term memory update.
+    """
+    if not hasattr(torch, 'compile'):
+        print('torch.compile requires PyTorch 2.0, running eagerly.')
+        return model
+    model.encode_image = torch.compile(model.encode_image,
+                                       mode=mode,
+                                       dynamic=False)
+    model.LSTT_forward = torch.compile(model.LSTT_forward,
+                                       mode=mode,
+                                       dynamic=True)
+    model.decode_id_logits = torch.compile(model.decode_id_logits,
+                                           mode=mode,
+                                           dynamic=False)
+    return model
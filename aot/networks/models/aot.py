@@ -97,12 +97,14 @@ class AOT(nn.Module):
                      short_term_memories,
                      curr_id_emb=None,
                      pos_emb=None,
-                     size_2d=(30, 30)):
+                     size_2d=(30, 30),
+                     long_term_attn_usage=None):
         n, c, h, w = curr_embs[-1].size()
         curr_emb = curr_embs[-1].view(n, c, h * w).permute(2, 0, 1)
         lstt_embs, lstt_memories = self.LSTT(curr_emb, long_term_memories,
                                              short_term_memories, curr_id_emb,
-                                             pos_emb, size_2d)
+                                             pos_emb, size_2d,
+                                             long_term_attn_usage)
         lstt_curr_memories, lstt_long_memories, lstt_short_memories = zip(
             *lstt_memories)
         return lstt_embs, lstt_curr_memories, lstt_long_memories, lstt_short_memories
@@ -4,8 +4,8 @@ import torch.nn.functional as F
 import os
 import sys
 sys.path.append("./aot")
-from aot.networks.engines.aot_engine import AOTEngine,AOTInferEngine
-from aot.networks.engines.deaot_engine import DeAOTEngine,DeAOTInferEngine
+from aot.networks.engines.aot_engine import AOTInferEngine,save_snapshot,load_snapshot
+from aot.networks.engines.deaot_engine import DeAOTInferEngine
 import importlib
 import numpy as np
 from PIL import Image
@@ -18,49 +18,147 @@ _palette = [0,0,0]+_palette
 
 import aot.dataloaders.video_transforms as tr
 from aot.utils.checkpoint import load_network
-from aot.networks.models import build_vos_model
+from aot.networks.models import build_vos_model, compile_vos_model
+from aot.networks.encoders.fuse import export_encoder
 from aot.networks.engines import build_engine
+from aot.networks.engines.multi_stream_engine import MultiStreamInferEngine
 from torchvision import transforms
+from tool.model_registry import get_model
+from tool.fast_load import flat_checkpoint_path, load_flat_model
+
+def bilinear_source_index(dst, in_size, out_size, align_corners):
+    '''
+    Source pixels and weights that F.interpolate(mode='bilinear') uses for the output coordinates dst.
+    '''
+    if align_corners:
+        src = dst * ((in_size - 1) / (out_size - 1) if out_size > 1 else 0.)
+    else:
+        src = ((dst + 0.5) * (in_size / out_size) - 0.5).clamp(min=0)
+    idx0 = src.long().clamp(max=in_size - 1)
+    idx1 = (idx0 + 1).clamp(max=in_size - 1)
+    return idx0, idx1, src - idx0
+
+
+def upsample_label(pred_id_logits, output_size, align_corners):
+    '''
+    Same label as argmax over pred_id_logits (1,C,h,w) bilinearly upsampled to output_size, without upsampling all C channels.
+    The argmax is taken at decoder resolution and the label map is upsampled; a pixel whose bilinear neighbours all have
+    the same label keeps it, and only pixels near label boundaries are resolved from their interpolated logits.
+    Return: the label at decoder resolution (1,1,h,w) and at output_size (1,1,H,W), both float
+    '''
+    low_label = torch.argmax(pred_id_logits, dim=1, keepdim=True).float()
+    if tuple(output_size) == tuple(low_label.shape[-2:]):
+        return low_label, low_label
+
+    label = F.interpolate(low_label, size=output_size, mode='nearest')
+    # the bilinear neighbours of an output pixel are within one decoder pixel of its nearest one
+    boundary = F.max_pool2d(low_label, 3, 1, 1) != -F.max_pool2d(-low_label, 3, 1, 1)
+    boundary = F.interpolate(boundary.float(), size=output_size, mode='nearest')
+    ys, xs = boundary[0, 0].nonzero(as_tuple=True)
+    if ys.numel() > 0:
+        height, width = pred_id_logits.shape[-2:]
+        y0, y1, ly = bilinear_source_index(ys.float(), height, output_size[0], align_corners)
+        x0, x1, lx = bilinear_source_index(xs.float(), width, output_size[1], align_corners)
+        logits = pred_id_logits[0]
+        top = logits[:, y0, x0] * (1 - lx) + logits[:, y0, x1] * lx
+        bottom = logits[:, y1, x0] * (1 - lx) + logits[:, y1, x1] * lx
+        label[0, 0, ys, xs] = torch.argmax(top * (1 - ly) + bottom * ly, dim=0).float()
+    return low_label, label
+
+
+def to_host_label(label):
+    '''
+    Starts a non-blocking copy of a label to a pinned uint8 host tensor.
+    Return: the host tensor and a cuda event recorded after the copy (None on cpu)
+    '''
+    label = label.to(torch.uint8)
+    if not label.is_cuda:
+        return label, None
+    host_label = torch.empty(label.shape, dtype=torch.uint8, pin_memory=True)
+    host_label.copy_(label, non_blocking=True)
+    copy_event = torch.cuda.Event()
+    copy_event.record()
+    return host_label, copy_event
+
 
 class AOTTracker(object):
     def __init__(self, cfg, gpu_id=0):
         self.gpu_id = gpu_id
-        self.model = build_vos_model(cfg.MODEL_VOS, cfg).cuda(gpu_id)
-        self.model, _ = load_network(self.model, cfg.TEST_CKPT_PATH, gpu_id)
+        # weights are loaded once per process and shared, the engine holding the memories is per tracker
+        self.model = get_model(('aot', cfg.MODEL_VOS, cfg.MODEL_ENCODER, cfg.TEST_CKPT_PATH, gpu_id, cfg.TEST_COMPILE,
+                                getattr(cfg, 'TEST_EXPORT_ENCODER', True)),
+                               lambda: self.build_model(cfg, gpu_id))
         # self.engine = self.build_tracker_engine(cfg.MODEL_ENGINE,
         #                            aot_model=self.model,
         #                            gpu_id=gpu_id,
         #                            short_term_mem_skip=4,
         #                            long_term_mem_gap=cfg.TEST_LONG_TERM_MEM_GAP)
-        self.engine = build_engine(cfg.MODEL_ENGINE,
-                                   phase='eval',
-                                   aot_model=self.model,
-                                   gpu_id=gpu_id,
-                                   short_term_mem_skip=1,
-                                   long_term_mem_gap=cfg.TEST_LONG_TERM_MEM_GAP)
+        self.engine = self.build_infer_engine(cfg)
+        self.align_corners = cfg.MODEL_ALIGN_CORNERS
+        # label of the last tracked frame at decoder resolution, fed back by update_memory
+        self.curr_label = None
+        self.copy_event = None
        
         self.transform = transforms.Compose([
             tr.MultiRestrictSize(cfg.TEST_MAX_SHORT_EDGE,
                                  cfg.TEST_MAX_LONG_EDGE, cfg.TEST_FLIP, 
-                                 cfg.TEST_MULTISCALE, cfg.MODEL_ALIGN_CORNERS),
+                                 cfg.TEST_MULTISCALE, cfg.MODEL_ALIGN_CORNERS,
+                                 size_bucket=cfg.TEST_SIZE_BUCKET),
             tr.MultiToTensor()
         ])
 
-        self.model.eval()
+    def build_infer_engine(self, cfg):
+        return build_engine(cfg.MODEL_ENGINE,
+                            phase='eval',
+                            aot_model=self.model,
+                            gpu_id=self.gpu_id,
+                            short_term_mem_skip=1,
+                            long_term_mem_gap=cfg.TEST_LONG_TERM_MEM_GAP,
+                            max_long_term_mem=cfg.TEST_LONG_TERM_MEM_MAX,
+                            long_term_mem_policy=cfg.TEST_LONG_TERM_MEM_POLICY,
+                            long_term_mem_dtype=cfg.TEST_LONG_TERM_MEM_DTYPE)
 
-    @torch.no_grad()
-    def add_reference_frame(self, frame, mask, obj_nums, frame_step, incremental=False):
+    @staticmethod
+    def build_model(cfg, gpu_id):
+        if getattr(cfg, 'TEST_FAST_LOAD', False):
+            # memory-mapped weights from a flat copy of the checkpoint, see tool/fast_load.py
+            model = load_flat_model(flat_checkpoint_path(cfg.TEST_CKPT_PATH),
+                                    lambda: build_vos_model(cfg.MODEL_VOS, cfg),
+                                    lambda: load_network(build_vos_model(cfg.MODEL_VOS, cfg).cuda(gpu_id), cfg.TEST_CKPT_PATH, gpu_id)[0],
+                                    torch.device('cuda', gpu_id))
+        else:
+            model = build_vos_model(cfg.MODEL_VOS, cfg).cuda(gpu_id)
+            model, _ = load_network(model, cfg.TEST_CKPT_PATH, gpu_id)
+        model.eval()
+        if getattr(cfg, 'TEST_EXPORT_ENCODER', True):
+            # bn folded into the convs and channels_last, checked against the original encoder
+            model.encoder = export_encoder(model.encoder)
+        if cfg.TEST_COMPILE:
+            # graphs are compiled on the first frames of each input size, see TEST_SIZE_BUCKET
+            compile_vos_model(model, mode=None if cfg.TEST_COMPILE is True else cfg.TEST_COMPILE)
+        return model
+
+    def preprocess(self, frame, mask=None):
+        '''
+        Resizes and uploads a frame (and its mask) as the engine inputs.
+        '''
         # mask = cv2.resize(mask, frame.shape[:2][::-1], interpolation = cv2.INTER_NEAREST)
 
-        sample = {
-            'current_img': frame,
-            'current_label': mask,
-        }
+        sample = {'current_img': frame}
+        if mask is not None:
+            sample['current_label'] = mask
     
         sample = self.transform(sample)
         frame = sample[0]['current_img'].unsqueeze(0).float().cuda(self.gpu_id)
+        if mask is None:
+            return frame
         mask = sample[0]['current_label'].unsqueeze(0).float().cuda(self.gpu_id)
         _mask = F.interpolate(mask,size=frame.shape[-2:],mode='nearest')
+        return frame, _mask
+
+    @torch.no_grad()
+    def add_reference_frame(self, frame, mask, obj_nums, frame_step, incremental=False):
+        frame, _mask = self.preprocess(frame, mask)
 
         if incremental:
             self.engine.add_reference_frame_incremental(frame, _mask, obj_nums=obj_nums, frame_step=frame_step)
@@ -71,26 +169,76 @@ class AOTTracker(object):
 
     @torch.no_grad()
     def track(self, image):
+        '''
+        image: numpy array (h,w,3)
+        Return: predicted label (1,1,h,w), uint8 on the host. The copy from the gpu is non-blocking,
+            call wait_label() before reading it.
+        '''
         output_height, output_width = image.shape[0], image.shape[1]
-        sample = {'current_img': image}
-        sample = self.transform(sample)
-        image = sample[0]['current_img'].unsqueeze(0).float().cuda(self.gpu_id)
+        image = self.preprocess(image)
         self.engine.match_propogate_one_frame(image)
-        pred_logit = self.engine.decode_current_logits((output_height, output_width))
+        # logits stay at decoder resolution, only the label is upsampled
+        pred_logit = self.engine.decode_current_logits()
 
-        # pred_prob = torch.softmax(pred_logit, dim=1)
-        pred_label = torch.argmax(pred_logit, dim=1,
-                                    keepdim=True).float()
+        self.curr_label, pred_label = upsample_label(pred_logit, (output_height, output_width), self.align_corners)
+        pred_label, self.copy_event = to_host_label(pred_label)
+        return pred_label
 
-        return  pred_label
+    def wait_label(self):
+        '''
+        Waits for the host copy of the label returned by the last track().
+        '''
+        if self.copy_event is not None:
+            self.copy_event.synchronize()
+            self.copy_event = None
     
     @torch.no_grad()
-    def update_memory(self, pred_label):
+    def update_memory(self, pred_label=None):
+        '''
+        pred_label: label (1,1,h,w) to memorize, by default the decoder resolution label of the last track()
+        '''
+        if pred_label is None:
+            pred_label = self.curr_label
+        else:
+            pred_label = pred_label.float().cuda(self.gpu_id)
         self.engine.update_memory(pred_label)
     
     @torch.no_grad()
     def restart(self):
         self.engine.restart_engine()
+        self.curr_label = None
+
+    def snapshot(self):
+        '''
+        State of the tracker after the last add_reference_frame() or update_memory(), to rewind to it with restore(),
+        e.g. to add a corrected mask at that frame and re-track only the following ones.
+        Snapshots share the memories with the tracker until either writes to them (copy-on-write).
+        '''
+        return self.engine.snapshot()
+
+    @torch.no_grad()
+    def restore(self, snapshot):
+        '''
+        snapshot: from snapshot() or load(), can be restored several times
+        '''
+        self.engine.restore(snapshot)
+        self.curr_label = None
+
+    def save(self, path, snapshot=None):
+        '''
+        Writes a snapshot (by default of the current state) to path, e.g. to resume a crashed job with load().
+        '''
+        save_snapshot(self.snapshot() if snapshot is None else snapshot, path)
+
+    @torch.no_grad()
+    def load(self, path):
+        '''
+        Restores the tracker from a file written by save().
+        Return: the loaded snapshot
+        '''
+        snapshot = load_snapshot(path, map_location=torch.device('cuda', self.gpu_id))
+        self.restore(snapshot)
+        return snapshot
     
     @torch.no_grad()
     def build_tracker_engine(self, name, **kwargs):
@@ -102,18 +250,106 @@ class AOTTracker(object):
             raise NotImplementedError
 
 
+class MultiStreamAOTTracker(AOTTracker):
+    '''
+    Tracks many videos at once: every step advances all given streams with batched
+    encoder, LSTT and decoder passes, see aot/networks/engines/multi_stream_engine.py.
+    A stream (any hashable id) starts with its first reference frame and keeps its own memories;
+    remove_stream drops a finished video so that a new one can take its place.
+    '''
+    def __init__(self, cfg, gpu_id=0):
+        super().__init__(cfg, gpu_id)
+        self.engine = MultiStreamInferEngine(self.model, lambda: self.build_infer_engine(cfg))
+        self.curr_labels = {}
+        self.copy_events = []
+
+    @torch.no_grad()
+    def add_reference_frame(self, stream_id, frame, mask, obj_nums, frame_step):
+        frame, _mask = self.preprocess(frame, mask)
+        self.engine.add_reference_frame(stream_id, frame, _mask, obj_nums=obj_nums, frame_step=frame_step)
+
+    @torch.no_grad()
+    def track(self, images):
+        '''
+        images: dict of stream id -> numpy array (h,w,3)
+        Return: dict of stream id -> predicted label (1,1,h,w), uint8 on the host, readable after wait_label()
+        '''
+        self.engine.match_propogate_one_frame(
+            {stream_id: self.preprocess(image) for stream_id, image in images.items()})
+        pred_logits = self.engine.decode_current_logits()
+
+        self.curr_labels, pred_labels, self.copy_events = {}, {}, []
+        for stream_id, pred_logit in pred_logits.items():
+            self.curr_labels[stream_id], pred_label = upsample_label(pred_logit, images[stream_id].shape[:2],
+                                                                     self.align_corners)
+            pred_labels[stream_id], copy_event = to_host_label(pred_label)
+            self.copy_events.append(copy_event)
+        return pred_labels
+
+    def wait_label(self):
+        for copy_event in self.copy_events:
+            if copy_event is not None:
+                copy_event.synchronize()
+        self.copy_events = []
+
+    @torch.no_grad()
+    def update_memory(self, pred_labels=None):
+        '''
+        pred_labels: dict of stream id -> label (1,1,h,w), by default the decoder resolution labels of the last track()
+        '''
+        if pred_labels is None:
+            pred_labels = self.curr_labels
+        else:
+            pred_labels = {stream_id: pred_label.float().cuda(self.gpu_id)
+                           for stream_id, pred_label in pred_labels.items()}
+        self.engine.update_memory(pred_labels)
+
+    @torch.no_grad()
+    def restart(self, stream_id=None):
+        if stream_id is None:
+            self.engine.restart_engine()
+            self.curr_labels = {}
+        else:
+            self.engine.restart_stream(stream_id)
+            self.curr_labels.pop(stream_id, None)
+
+    def remove_stream(self, stream_id):
+        self.engine.remove_stream(stream_id)
+        self.curr_labels.pop(stream_id, None)
+
+    def snapshot(self, stream_id):
+        return self.engine.snapshot_stream(stream_id)
+
+    @torch.no_grad()
+    def restore(self, stream_id, snapshot):
+        '''
+        Rewinds a stream (or starts a new one) to a snapshot of a stream, see AOTTracker.snapshot()
+        '''
+        self.engine.restore_stream(stream_id, snapshot)
+        self.curr_labels.pop(stream_id, None)
+
+    def save(self, path, stream_id):
+        save_snapshot(self.snapshot(stream_id), path)
+
+    @torch.no_grad()
+    def load(self, path, stream_id):
+        snapshot = load_snapshot(path, map_location=torch.device('cuda', self.gpu_id))
+        self.restore(stream_id, snapshot)
+        return snapshot
+
+
 class AOTTrackerInferEngine(AOTInferEngine):
-    def __init__(self, aot_model, gpu_id=0, long_term_mem_gap=9999, short_term_mem_skip=1, max_aot_obj_num=None):
-        super().__init__(aot_model, gpu_id, long_term_mem_gap, short_term_mem_skip, max_aot_obj_num)
+    def __init__(self, aot_model, gpu_id=0, long_term_mem_gap=9999, short_term_mem_skip=1, max_aot_obj_num=None,
+                 max_long_term_mem=-1, long_term_mem_policy='recent', long_term_mem_dtype=None):
+        super().__init__(aot_model, gpu_id, long_term_mem_gap, short_term_mem_skip, max_aot_obj_num,
+                         max_long_term_mem, long_term_mem_policy, long_term_mem_dtype)
     def add_reference_frame_incremental(self, img, mask, obj_nums, frame_step=-1):
         if isinstance(obj_nums, list):
             obj_nums = obj_nums[0]
         self.obj_nums = obj_nums
         aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
         while (aot_num > len(self.aot_engines)):
-            new_engine = AOTEngine(self.AOT, self.gpu_id,
-                                   self.long_term_mem_gap,
-                                   self.short_term_mem_skip)
+            new_engine = self.build_sub_engine()
             new_engine.eval()
             self.aot_engines.append(new_engine)
 
@@ -134,22 +370,23 @@ class AOTTrackerInferEngine(AOTInferEngine):
             if img_embs is None:  # reuse image embeddings
                 img_embs = aot_engine.curr_enc_embs
 
+        self.ungroup_engines()
         self.update_size()
 
 
 
 class DeAOTTrackerInferEngine(DeAOTInferEngine):
-    def __init__(self, aot_model, gpu_id=0, long_term_mem_gap=9999, short_term_mem_skip=1, max_aot_obj_num=None):
-        super().__init__(aot_model, gpu_id, long_term_mem_gap, short_term_mem_skip, max_aot_obj_num)
+    def __init__(self, aot_model, gpu_id=0, long_term_mem_gap=9999, short_term_mem_skip=1, max_aot_obj_num=None,
+                 max_long_term_mem=-1, long_term_mem_policy='recent', long_term_mem_dtype=None):
+        super().__init__(aot_model, gpu_id, long_term_mem_gap, short_term_mem_skip, max_aot_obj_num,
+                         max_long_term_mem, long_term_mem_policy, long_term_mem_dtype)
     def add_reference_frame_incremental(self, img, mask, obj_nums, frame_step=-1):
         if isinstance(obj_nums, list):
             obj_nums = obj_nums[0]
         self.obj_nums = obj_nums
         aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
         while (aot_num > len(self.aot_engines)):
-            new_engine = DeAOTEngine(self.AOT, self.gpu_id,
-                                   self.long_term_mem_gap,
-                                   self.short_term_mem_skip)
+            new_engine = self.build_sub_engine()
             new_engine.eval()
             self.aot_engines.append(new_engine)
 
@@ -170,16 +407,25 @@ class DeAOTTrackerInferEngine(DeAOTInferEngine):
             if img_embs is None:  # reuse image embeddings
                 img_embs = aot_engine.curr_enc_embs
 
+        self.ungroup_engines()
         self.update_size()
 
 
-def get_aot(args):
+def get_aot(args, multi_stream=False):
     # build vos engine
     engine_config = importlib.import_module('configs.' + 'pre_ytb_dav')
     cfg = engine_config.EngineConfig(args['phase'], args['model'])
     cfg.TEST_CKPT_PATH = args['model_path']
     cfg.TEST_LONG_TERM_MEM_GAP = args['long_term_mem_gap']
+    cfg.TEST_LONG_TERM_MEM_MAX = args.get('max_long_term_mem', -1)
+    cfg.TEST_LONG_TERM_MEM_POLICY = args.get('long_term_mem_policy', 'recent')
+    cfg.TEST_LONG_TERM_MEM_DTYPE = args.get('long_term_mem_dtype', None)
+    cfg.TEST_FAST_LOAD = args.get('fast_load', False)
+    cfg.TEST_COMPILE = args.get('compile', False)
+    cfg.TEST_EXPORT_ENCODER = args.get('export_encoder', True)
+    cfg.TEST_SIZE_BUCKET = args.get('size_bucket', None)
 
-    # init AOTTracker
-    tracker = AOTTracker(cfg, args['gpu_id'])
+    # init AOTTracker, or MultiStreamAOTTracker to track several videos in lockstep
+    tracker_class = MultiStreamAOTTracker if multi_stream else AOTTracker
+    tracker = tracker_class(cfg, args['gpu_id'])
     return tracker
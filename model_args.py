@@ -11,17 +11,33 @@ sam_args = {
         'min_mask_region_area': 200,
     },
     'gpu_id': 0,
+    'embedding_cache_mb': 256, # memory cap of the cache of SAM image embeddings
+    'embedding_cache_dir': None, # directory of an on-disk cache of SAM image embeddings kept across runs, e.g. './ckpt/embedding_cache'
+    'embedding_cache_disk_mb': 4096, # size cap of the on-disk embedding cache
+    'attn_impl': 'default', # attention kernel of the SAM image encoder: default, sdpa (fused, still builds the full relative position mask), or chunked (low memory)
+    'image_size': 1024, # input size of the SAM image encoder, smaller (e.g. 512, 768) is faster for small frames
+    'quantize': False, # dynamic int8 quantized SAM for cpu inference, requires 'gpu_id': 'cpu'
+    'backend': 'torch', # 'onnx' runs SAM with onnxruntime on cpu, requires 'gpu_id': 'cpu' and models from sam/scripts/export_onnx_model.py
+    'fast_load': False, # convert the checkpoint once to a flat file next to it, later starts memory-map the weights
 }
 aot_args = {
     'phase': 'PRE_YTB_DAV',
     'model': 'r50_deaotl',
     'model_path': 'ckpt/R50_DeAOTL_PRE_YTB_DAV.pth',
     'long_term_mem_gap': 9999,
+    'max_long_term_mem': -1, # cap on the long-term memory frames (reference frames are always kept), -1 for unbounded
+    'long_term_mem_policy': 'recent', # frame evicted when the cap is reached: recent (oldest), confidence (least confident prediction) or usage (least attended)
+    'long_term_mem_dtype': None, # store the long-term memory as float16, bfloat16 or int8 (per-channel scales) to cut its size, None keeps float32
     'gpu_id': 0,
+    'fast_load': False, # convert the checkpoint once to a flat file next to it, later starts memory-map the weights
+    'export_encoder': True, # fold BatchNorm into the encoder convs and run them channels_last, checked against the original at load
+    'compile': False, # torch.compile the encoder, LSTT and decoder (True or a torch.compile mode), the first frames of each input size compile
+    'size_bucket': None, # round input sizes to multiples of it (a multiple of 16, e.g. 64) so that videos share a few compiled sizes
 }
 segtracker_args = {
     'sam_gap': 10, # the interval to run sam to segment new objects
     'min_area': 200, # minimal mask area to add a new mask as a new object
     'max_obj_num': 255, # maximal object number to track in a video
     'min_new_obj_iou': 0.8, # the background area ratio of a new object should > 80% 
+    'sam_warm_start': False, # seed SAM from the tracked objects instead of a full point grid
 }
\ No newline at end of file
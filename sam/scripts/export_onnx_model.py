@@ -20,7 +20,10 @@ except ImportError:
     onnxruntime_exists = False
 
 parser = argparse.ArgumentParser(
-    description="Export the SAM prompt encoder and mask decoder to an ONNX model."
+    description=(
+        "Export the SAM prompt encoder and mask decoder to an ONNX model, "
+        "and optionally the image encoder to a second ONNX model."
+    )
 )
 
 parser.add_argument(
@@ -38,6 +41,23 @@ parser.add_argument(
     help="In ['default', 'vit_h', 'vit_l', 'vit_b']. Which type of SAM model to export.",
 )
 
+parser.add_argument(
+    "--encoder-output",
+    type=str,
+    default=None,
+    help=(
+        "If set, the image encoder is also exported, to this filename. It takes "
+        "the normalized and padded image as input, see Sam.preprocess."
+    ),
+)
+
+parser.add_argument(
+    "--image-size",
+    type=int,
+    default=1024,
+    help="The input size of the image encoder.",
+)
+
 parser.add_argument(
     "--return-single-mask",
     action="store_true",
@@ -103,9 +123,10 @@ def run_export(
     gelu_approximate: bool = False,
     use_stability_score: bool = False,
     return_extra_metrics=False,
+    image_size: int = 1024,
 ):
     print("Loading model...")
-    sam = sam_model_registry[model_type](checkpoint=checkpoint)
+    sam = sam_model_registry[model_type](checkpoint=checkpoint, image_size=image_size)
 
     onnx_model = SamOnnxModel(
         model=sam,
@@ -119,9 +140,11 @@ def run_export(
             if isinstance(m, torch.nn.GELU):
                 m.approximate = "tanh"
 
+    # Several prompts on the same image can be decoded in one run
     dynamic_axes = {
-        "point_coords": {1: "num_points"},
-        "point_labels": {1: "num_points"},
+        "point_coords": {0: "batch_size", 1: "num_points"},
+        "point_labels": {0: "batch_size", 1: "num_points"},
+        "mask_input": {0: "batch_size"},
     }
 
     embed_dim = sam.prompt_encoder.embed_dim
@@ -129,9 +152,9 @@ def run_export(
     mask_input_size = [4 * x for x in embed_size]
     dummy_inputs = {
         "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
-        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
-        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
-        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(2, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(2, 5), dtype=torch.float),
+        "mask_input": torch.randn(2, 1, *mask_input_size, dtype=torch.float),
         "has_mask_input": torch.tensor([1], dtype=torch.float),
         "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
     }
@@ -165,6 +188,58 @@ def run_export(
         print("Model has successfully been run with ONNXRuntime.")
 
 
+def run_encoder_export(
+    model_type: str,
+    checkpoint: str,
+    output: str,
+    opset: int,
+    gelu_approximate: bool = False,
+    image_size: int = 1024,
+):
+    print("Loading model...")
+    sam = sam_model_registry[model_type](checkpoint=checkpoint, image_size=image_size)
+    image_encoder = sam.image_encoder.eval()
+
+    if gelu_approximate:
+        for n, m in image_encoder.named_modules():
+            if isinstance(m, torch.nn.GELU):
+                m.approximate = "tanh"
+
+    img_size = image_encoder.img_size
+    dummy_inputs = {
+        "input_image": torch.randn(1, 3, img_size, img_size, dtype=torch.float),
+    }
+
+    with torch.no_grad():
+        _ = image_encoder(*dummy_inputs.values())
+
+    output_names = ["image_embeddings"]
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+        warnings.filterwarnings("ignore", category=UserWarning)
+        with open(output, "wb") as f:
+            print(f"Exporing onnx image encoder to {output}...")
+            torch.onnx.export(
+                image_encoder,
+                tuple(dummy_inputs.values()),
+                f,
+                export_params=True,
+                verbose=False,
+                opset_version=opset,
+                do_constant_folding=True,
+                input_names=list(dummy_inputs.keys()),
+                output_names=output_names,
+                dynamic_axes={"input_image": {0: "batch_size"}},
+            )
+
+    if onnxruntime_exists:
+        ort_inputs = {k: to_numpy(v) for k, v in dummy_inputs.items()}
+        ort_session = onnxruntime.InferenceSession(output)
+        _ = ort_session.run(None, ort_inputs)
+        print("Image encoder has successfully been run with ONNXRuntime.")
+
+
 def to_numpy(tensor):
     return tensor.cpu().numpy()
 
@@ -180,8 +255,19 @@ if __name__ == "__main__":
         gelu_approximate=args.gelu_approximate,
         use_stability_score=args.use_stability_score,
         return_extra_metrics=args.return_extra_metrics,
+        image_size=args.image_size,
     )
 
+    if args.encoder_output is not None:
+        run_encoder_export(
+            model_type=args.model_type,
+            checkpoint=args.checkpoint,
+            output=args.encoder_output,
+            opset=args.opset,
+            gelu_approximate=args.gelu_approximate,
+            image_size=args.image_size,
+        )
+
     if args.quantize_out is not None:
         assert onnxruntime_exists, "onnxruntime is required to quantize the model."
         from onnxruntime.quantization import QuantType  # type: ignore
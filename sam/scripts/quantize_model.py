@@ -0,0 +1,134 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import cv2  # type: ignore
+import numpy as np
+import torch
+
+from segment_anything import SamPredictor, sam_model_registry
+from segment_anything.utils.amg import build_point_grid
+from segment_anything.utils.quantization import build_quantized_sam
+
+import argparse
+import os
+import time
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Quantizes a SAM model with dynamic int8 quantization for CPU inference, "
+        "saves the quantized weights, and compares its masks to the fp32 model "
+        "on a fixed set of images. Requires open-cv."
+    )
+)
+
+parser.add_argument(
+    "--checkpoint", type=str, required=True, help="The path to the SAM model checkpoint."
+)
+
+parser.add_argument(
+    "--output",
+    type=str,
+    required=True,
+    help="The filename to save the quantized weights to.",
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    required=True,
+    help="In ['default', 'vit_h', 'vit_l', 'vit_b']. Which type of SAM model to quantize.",
+)
+
+parser.add_argument(
+    "--image-size",
+    type=int,
+    default=1024,
+    help="The input size of the image encoder.",
+)
+
+parser.add_argument(
+    "--input",
+    type=str,
+    default=os.path.join(os.path.dirname(__file__), "..", "notebooks", "images"),
+    help="Path to either a single image or folder of images to check the accuracy on.",
+)
+
+parser.add_argument(
+    "--points-per-side",
+    type=int,
+    default=4,
+    help="Each image is prompted with single points on a grid with this many points per side.",
+)
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def check_accuracy(
+    fp32_predictor: SamPredictor, int8_predictor: SamPredictor, images, points_per_side: int
+) -> None:
+    ious = []
+    for path in images:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"Could not load '{path}' as an image, skipping...")
+            continue
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        points = build_point_grid(points_per_side) * np.array(image.shape[:2])[None, ::-1]
+
+        timings = []
+        for predictor in (fp32_predictor, int8_predictor):
+            tic = time.perf_counter()
+            predictor.set_image(image)
+            timings.append(time.perf_counter() - tic)
+
+        image_ious = []
+        for point in points:
+            fp32_masks, fp32_scores, _ = fp32_predictor.predict(point[None], np.array([1]))
+            int8_masks, _, _ = int8_predictor.predict(point[None], np.array([1]))
+            # Compare the mask the fp32 model would pick
+            best = np.argmax(fp32_scores)
+            image_ious.append(mask_iou(fp32_masks[best], int8_masks[best]))
+        ious.extend(image_ious)
+        print(
+            f"{os.path.basename(path)}: mean IoU {np.mean(image_ious):.4f}, "
+            f"min IoU {np.min(image_ious):.4f}, "
+            f"encoder fp32 {timings[0]:.2f}s, int8 {timings[1]:.2f}s"
+        )
+    if len(ious) > 0:
+        print(f"Overall: mean IoU {np.mean(ious):.4f}, min IoU {np.min(ious):.4f}")
+
+
+def main(args: argparse.Namespace) -> None:
+    print("Loading fp32 model...")
+    sam = sam_model_registry[args.model_type](
+        checkpoint=args.checkpoint, image_size=args.image_size
+    )
+    print(f"Quantizing model and writing to {args.output}...")
+    quantized_sam = build_quantized_sam(
+        args.model_type,
+        checkpoint=args.checkpoint,
+        quantized_checkpoint=args.output,
+        image_size=args.image_size,
+    )
+
+    if not os.path.isdir(args.input):
+        images = [args.input]
+    else:
+        images = sorted(os.path.join(args.input, f) for f in os.listdir(args.input))
+    print("Comparing int8 masks to fp32 masks...")
+    with torch.no_grad():
+        check_accuracy(
+            SamPredictor(sam), SamPredictor(quantized_sam), images, args.points_per_side
+        )
+    print("Done!")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -6,23 +6,30 @@
 
 import numpy as np
 import torch
+from torch.nn import functional as F
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+import math
+import time
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from .modeling import Sam
-from .predictor import SamPredictor
+from .predictor import SamPredictor, image_as_tensor
 from .utils.amg import (
+    AdaptiveBatchSize,
     MaskData,
     area_from_rle,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
+    build_point_grid,
     calculate_stability_score,
     coco_encode_rle,
     generate_crop_boxes,
     is_box_near_crop_edge,
+    is_out_of_memory_error,
     mask_to_rle_pytorch,
     remove_small_regions,
     rle_to_mask,
@@ -35,9 +42,10 @@ from .utils.amg import (
 class SamAutomaticMaskGenerator:
     def __init__(
         self,
-        model: Sam,
+        model: Union[Sam, SamPredictor],
         points_per_side: Optional[int] = 32,
-        points_per_batch: int = 64,
+        points_per_batch: Optional[int] = 64,
+        crops_per_batch: int = 8,
         pred_iou_thresh: float = 0.88,
         stability_score_thresh: float = 0.95,
         stability_score_offset: float = 1.0,
@@ -49,6 +57,10 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        low_res_filtering: bool = False,
+        warm_start_points_per_side: int = 8,
+        batch_memory_limit: Optional[int] = None,
+        embedding_cache: Optional[Any] = None,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -57,13 +69,21 @@ class SamAutomaticMaskGenerator:
         for SAM with a ViT-H backbone.
 
         Arguments:
-          model (Sam): The SAM model to use for mask prediction.
+          model (Sam or SamPredictor): The SAM model to use for mask
+            prediction, or a predictor to run it with, e.g. SamOnnxPredictor.
           points_per_side (int or None): The number of points to be sampled
             along one side of the image. The total number of points is
             points_per_side**2. If None, 'point_grids' must provide explicit
             point sampling.
-          points_per_batch (int): Sets the number of points run simultaneously
+          points_per_batch (int or None): Sets the number of points run simultaneously
             by the model. Higher numbers may be faster but use more GPU memory.
+            If None, the number is chosen per image from the available memory
+            and the measured latency. In both cases, it is halved if the
+            model runs out of memory.
+          crops_per_batch (int): Sets the number of image crops run
+            simultaneously through the image encoder. All crop embeddings are
+            computed up front and kept until the image is done. Higher numbers
+            may be faster but use more GPU memory.
           pred_iou_thresh (float): A filtering threshold in [0,1], using the
             model's predicted mask quality.
           stability_score_thresh (float): A filtering threshold in [0,1], using
@@ -93,6 +113,22 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          low_res_filtering (bool): If true, the stability score and the crop
+            edge filter are computed on the low resolution mask logits of the
+            decoder, and only the surviving masks are upscaled to the original
+            image size. Much cheaper for large images, at the cost of slightly
+            approximate stability scores.
+          warm_start_points_per_side (int): The number of points sampled
+            along one side of the sparse residual grid used when 'generate'
+            is given prior masks. Only points outside the prior masks are
+            used as prompts.
+          batch_memory_limit (int or None): A ceiling in bytes on the memory
+            the process may use, considered when points_per_batch is None.
+            On CPU, the memory in use is measured as the resident set size.
+          embedding_cache (object or None): An optional cache of crop
+            embeddings, e.g. on disk, with get(key) returning (features,
+            original_size, input_size) or None, and put(key, features,
+            original_size, input_size). Used when generate is given a cache_key.
         """
 
         assert (points_per_side is None) != (
@@ -120,8 +156,10 @@ class SamAutomaticMaskGenerator:
         if min_mask_region_area > 0:
             import cv2  # type: ignore # noqa: F401
 
-        self.predictor = SamPredictor(model)
+        self.predictor = model if isinstance(model, SamPredictor) else SamPredictor(model)
         self.points_per_batch = points_per_batch
+        self.batch_size = AdaptiveBatchSize(points_per_batch, batch_memory_limit)
+        self.crops_per_batch = crops_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
         self.stability_score_offset = stability_score_offset
@@ -132,14 +170,32 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.low_res_filtering = low_res_filtering
+        self.warm_start_point_grid = build_point_grid(warm_start_points_per_side)
+        self.embedding_cache = embedding_cache
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self,
+        image: np.ndarray,
+        prior_mask: Optional[np.ndarray] = None,
+        cache_key: Optional[Any] = None,
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          prior_mask (np.ndarray or None): An optional HW label map of objects
+            already known in this image, e.g. the tracked masks of a video
+            frame, with 0 as background. If given, the generator warm-starts:
+            each object is prompted with a point, its box and its mask, and
+            only a sparse residual grid of points outside these objects is
+            sampled. Crop layers are not used in this mode.
+          cache_key (hashable or None): The identity of the image, e.g. a
+            (video hash, frame index) pair. If given, crop embeddings are
+            looked up in and added to embedding_cache, keyed by
+            (cache_key, crop box).
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -160,7 +216,7 @@ class SamAutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, prior_mask, cache_key)
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -194,17 +250,29 @@ class SamAutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self,
+        image: np.ndarray,
+        prior_mask: Optional[np.ndarray] = None,
+        cache_key: Optional[Any] = None,
+    ) -> MaskData:
         orig_size = image.shape[:2]
-        crop_boxes, layer_idxs = generate_crop_boxes(
-            orig_size, self.crop_n_layers, self.crop_overlap_ratio
-        )
+        if prior_mask is not None:
+            crop_boxes, layer_idxs = [[0, 0, orig_size[1], orig_size[0]]], [0]
+        else:
+            crop_boxes, layer_idxs = generate_crop_boxes(
+                orig_size, self.crop_n_layers, self.crop_overlap_ratio
+            )
 
-        # Iterate over image crops
+        # Embed all crops in batches, then iterate over image crops
+        crop_embeddings = self._encode_crops(image, crop_boxes, cache_key)
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
+        for crop_box, layer_idx, crop_embedding in zip(crop_boxes, layer_idxs, crop_embeddings):
+            crop_data = self._process_crop(
+                image, crop_box, layer_idx, orig_size, crop_embedding, prior_mask
+            )
             data.cat(crop_data)
+        del crop_embeddings
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -222,29 +290,103 @@ class SamAutomaticMaskGenerator:
         data.to_numpy()
         return data
 
+    def _encode_crops(
+        self, image: np.ndarray, crop_boxes: List[List[int]], cache_key: Optional[Any] = None
+    ) -> List[torch.Tensor]:
+        """
+        Calculates the image embeddings of all crops, running the image
+        encoder on batches of crops_per_batch crops. Returns one 1xCxHxW
+        embedding per crop box. Embeddings in the embedding cache are
+        loaded instead of calculated.
+        """
+        transform = self.predictor.transform
+        model = self.predictor.model
+        use_cache = self.embedding_cache is not None and cache_key is not None
+        crop_keys = [(cache_key, tuple(int(v) for v in crop_box)) for crop_box in crop_boxes]
+        crop_embeddings: List[Optional[torch.Tensor]] = [None] * len(crop_boxes)
+        if use_cache:
+            for i, crop_key in enumerate(crop_keys):
+                cached = self.embedding_cache.get(crop_key)
+                if cached is not None:
+                    # e.g. fp16 features memory-mapped from disk, converted on the device
+                    crop_embeddings[i] = cached[0].to(self.predictor.device).float()
+        missing = [i for i, features in enumerate(crop_embeddings) if features is None]
+        if len(missing) == 0:
+            return crop_embeddings
+
+        # Upload the image once, crops are views of it
+        image_torch, flipped = image_as_tensor(image, self.predictor.device)
+        image_torch = image_torch.permute(2, 0, 1)
+        for (idxs,) in batch_iterator(self.crops_per_batch, missing):
+            input_images = self.predictor.get_input_buffer(len(idxs))
+            input_sizes = []
+            for i, idx in enumerate(idxs):
+                x0, y0, x1, y1 = crop_boxes[idx]
+                input_image = transform.apply_image_torch(image_torch[None, :, y0:y1, x0:x1])
+                self.predictor.preprocess_into(input_image[0], input_images[i], flipped)
+                input_sizes.append(tuple(input_image.shape[-2:]))
+            features = model.image_encoder(input_images)
+            for idx, crop_features, input_size in zip(idxs, features.split(1, dim=0), input_sizes):
+                crop_embeddings[idx] = crop_features
+                if use_cache:
+                    x0, y0, x1, y1 = crop_boxes[idx]
+                    self.embedding_cache.put(
+                        crop_keys[idx], crop_features, (y1 - y0, x1 - x0), input_size
+                    )
+        return crop_embeddings
+
     def _process_crop(
         self,
         image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        crop_embedding: Optional[torch.Tensor] = None,
+        prior_mask: Optional[np.ndarray] = None,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        # Crop the image and calculate embeddings, unless already computed
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        if crop_embedding is None:
+            self.predictor.set_image(cropped_im)
+        else:
+            input_size = self.predictor.transform.get_preprocess_shape(
+                cropped_im_size[0], cropped_im_size[1], self.predictor.transform.target_length
+            )
+            self.predictor.set_image_embedding(crop_embedding, cropped_im_size, input_size)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        if prior_mask is None:
+            points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        else:
+            # Only sample the sparse residual grid where no prior object is
+            points_for_image = self.warm_start_point_grid * points_scale
+            points_idx = points_for_image.astype(int)
+            points_for_image = points_for_image[prior_mask[points_idx[:, 1], points_idx[:, 0]] == 0]
 
-        # Generate masks for this crop in batches
         data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
-            data.cat(batch_data)
-            del batch_data
+        self.batch_size.reset(self._bytes_per_prompt(orig_size), self.predictor.device)
+
+        # Prompt each prior object with its point, box and mask
+        if prior_mask is not None:
+            obj_ids = np.unique(prior_mask)
+            obj_ids = obj_ids[obj_ids != 0]
+
+            def process_prior_batch(ids: np.ndarray) -> MaskData:
+                points, boxes, mask_inputs = self._prior_prompts(prior_mask, ids)
+                return self._process_batch(
+                    points, cropped_im_size, crop_box, orig_size, boxes, mask_inputs
+                )
+
+            data.cat(self._process_in_batches(obj_ids, process_prior_batch))
+
+        # Generate masks for this crop in batches
+        process_batch = partial(
+            self._process_batch, im_size=cropped_im_size, crop_box=crop_box, orig_size=orig_size
+        )
+        data.cat(self._process_in_batches(points_for_image, process_batch))
         self.predictor.reset_image()
 
         # Remove duplicates within this crop.
@@ -263,12 +405,56 @@ class SamAutomaticMaskGenerator:
 
         return data
 
+    def _process_in_batches(
+        self, prompts: np.ndarray, process: Callable[[np.ndarray], MaskData]
+    ) -> MaskData:
+        """
+        Runs process on consecutive batches of prompts and concatenates the
+        results. Batches are sized by self.batch_size, which learns from the
+        latency of each batch and shrinks when a batch runs out of memory.
+        """
+        data = MaskData()
+        start = 0
+        while start < len(prompts):
+            batch = prompts[start : start + self.batch_size.batch_size]
+            tic = time.perf_counter()
+            try:
+                batch_data = process(batch)
+            except (RuntimeError, MemoryError) as e:
+                if not is_out_of_memory_error(e) or self.batch_size.batch_size == 1:
+                    raise
+                batch_data = None
+            if batch_data is None:
+                # Retry outside the except block, so the failed batch is freed
+                if self.predictor.device.type == "cuda":
+                    torch.cuda.empty_cache()
+                self.batch_size.backoff()
+                continue
+            self.batch_size.update(len(batch), time.perf_counter() - tic)
+            data.cat(batch_data)
+            del batch_data
+            start += len(batch)
+        return data
+
+    def _bytes_per_prompt(self, orig_size: Tuple[int, ...]) -> int:
+        """Estimates the peak memory of the mask logits predicted for one prompt."""
+        num_masks = self.predictor.model.mask_decoder.num_multimask_outputs
+        img_size = self.predictor.model.image_encoder.img_size
+        if self.low_res_filtering:
+            # Only the masks surviving the filters are upscaled
+            pixels = img_size**2 // 16 + (img_size**2 + 2 * orig_size[0] * orig_size[1]) // 4
+        else:
+            pixels = img_size**2 + 2 * orig_size[0] * orig_size[1]
+        return num_masks * pixels * 4
+
     def _process_batch(
         self,
         points: np.ndarray,
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
+        boxes: Optional[np.ndarray] = None,
+        mask_inputs: Optional[torch.Tensor] = None,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -276,11 +462,21 @@ class SamAutomaticMaskGenerator:
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+        in_boxes = None
+        if boxes is not None:
+            transformed_boxes = self.predictor.transform.apply_boxes(boxes, im_size)
+            in_boxes = torch.as_tensor(
+                transformed_boxes, dtype=torch.float, device=self.predictor.device
+            )
         masks, iou_preds, _ = self.predictor.predict_torch(
             in_points[:, None, :],
             in_labels[:, None],
-            multimask_output=True,
+            boxes=in_boxes,
+            mask_input=mask_inputs,
+            # Box prompts are not ambiguous, so one mask per prompt is enough
+            multimask_output=boxes is None,
             return_logits=True,
+            upscale_masks=not self.low_res_filtering,
         )
 
         # Serialize predictions and store in MaskData
@@ -296,6 +492,10 @@ class SamAutomaticMaskGenerator:
             keep_mask = data["iou_preds"] > self.pred_iou_thresh
             data.filter(keep_mask)
 
+        if self.low_res_filtering:
+            self._filter_low_res_masks(data, im_size, crop_box, orig_size)
+            return data
+
         # Calculate stability score
         data["stability_score"] = calculate_stability_score(
             data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
@@ -320,6 +520,97 @@ class SamAutomaticMaskGenerator:
 
         return data
 
+    def _prior_prompts(
+        self, prior_mask: np.ndarray, obj_ids: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, torch.Tensor]:
+        """
+        Builds a prompt for each object in a prior label map: the mask pixel
+        closest to the object's centroid, the object's box in XYXY format and
+        the object's mask as low resolution logits. Expects the predictor's
+        image to be set to the image the label map belongs to.
+        """
+        points, boxes = [], []
+        for obj_id in obj_ids:
+            ys, xs = np.nonzero(prior_mask == obj_id)
+            nearest = np.argmin((xs - xs.mean()) ** 2 + (ys - ys.mean()) ** 2)
+            points.append([xs[nearest], ys[nearest]])
+            boxes.append([xs.min(), ys.min(), xs.max(), ys.max()])
+
+        # Resize and pad the binary masks like the image, then downscale them
+        # to the mask input size of the prompt encoder
+        model = self.predictor.model
+        prior_torch = torch.as_tensor(prior_mask, device=self.predictor.device)
+        obj_ids_torch = torch.as_tensor(obj_ids, device=self.predictor.device)
+        masks = (prior_torch[None, None] == obj_ids_torch[:, None, None, None]).float()
+        masks = F.interpolate(
+            masks, self.predictor.input_size, mode="bilinear", align_corners=False
+        )
+        h, w = masks.shape[-2:]
+        img_size = model.image_encoder.img_size
+        masks = F.pad(masks, (0, img_size - w, 0, img_size - h))
+        masks = F.interpolate(
+            masks, model.prompt_encoder.mask_input_size, mode="bilinear", align_corners=False
+        )
+        # Map [0, 1] coverage to logits of roughly the magnitude SAM predicts
+        mask_inputs = (masks * 2 - 1) * 10.0
+
+        return np.array(points, dtype=float), np.array(boxes, dtype=float), mask_inputs
+
+    def _filter_low_res_masks(
+        self,
+        data: MaskData,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Applies the stability score and crop edge filters to the low
+        resolution mask logits in data, then upscales the surviving masks
+        and compresses them to RLE. Edits data in place.
+        """
+        orig_h, orig_w = orig_size
+        model = self.predictor.model
+        input_h, input_w = self.predictor.input_size
+
+        # Only look at the part of the low res logits that covers the image
+        low_res_h, low_res_w = data["masks"].shape[-2:]
+        scale = low_res_h / model.image_encoder.img_size
+        valid_h = min(math.ceil(input_h * scale), low_res_h)
+        valid_w = min(math.ceil(input_w * scale), low_res_w)
+        low_res_masks = data["masks"][..., :valid_h, :valid_w]
+
+        # Calculate stability score
+        data["stability_score"] = calculate_stability_score(
+            low_res_masks, model.mask_threshold, self.stability_score_offset
+        )
+        if self.stability_score_thresh > 0.0:
+            keep_mask = data["stability_score"] >= self.stability_score_thresh
+            data.filter(keep_mask)
+            low_res_masks = low_res_masks[keep_mask]
+
+        # Filter boxes that touch crop boundaries, with boxes scaled up from low res
+        low_res_boxes = batched_mask_to_box(low_res_masks > model.mask_threshold)
+        box_scale = torch.tensor(
+            [im_size[1] / valid_w, im_size[0] / valid_h] * 2, device=low_res_boxes.device
+        )
+        keep_mask = ~is_box_near_crop_edge(
+            low_res_boxes * box_scale, crop_box, [0, 0, orig_w, orig_h]
+        )
+        if not torch.all(keep_mask):
+            data.filter(keep_mask)
+
+        # Upscale surviving masks, then threshold masks and calculate boxes
+        masks = model.postprocess_masks(
+            data["masks"].unsqueeze(1), self.predictor.input_size, self.predictor.original_size
+        ).squeeze(1)
+        data["masks"] = masks > model.mask_threshold
+        data["boxes"] = batched_mask_to_box(data["masks"])
+
+        # Compress to RLE
+        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
+        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        del data["masks"]
+
     @staticmethod
     def postprocess_small_regions(
         mask_data: MaskData, min_area: int, nms_thresh: float
@@ -5,42 +5,50 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch
+from torch.nn import functional as F
 
 from functools import partial
+from typing import Dict
 
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
 
 
-def build_sam_vit_h(checkpoint=None):
+def build_sam_vit_h(checkpoint=None, attn_impl="default", image_size=1024):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[7, 15, 23, 31],
         checkpoint=checkpoint,
+        attn_impl=attn_impl,
+        image_size=image_size,
     )
 
 
 build_sam = build_sam_vit_h
 
 
-def build_sam_vit_l(checkpoint=None):
+def build_sam_vit_l(checkpoint=None, attn_impl="default", image_size=1024):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[5, 11, 17, 23],
         checkpoint=checkpoint,
+        attn_impl=attn_impl,
+        image_size=image_size,
     )
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, attn_impl="default", image_size=1024):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        attn_impl=attn_impl,
+        image_size=image_size,
     )
 
 
@@ -58,10 +66,12 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    attn_impl="default",
+    image_size=1024,
 ):
     prompt_embed_dim = 256
-    image_size = 1024
     vit_patch_size = 16
+    assert image_size % vit_patch_size == 0, f"image_size must be a multiple of {vit_patch_size}."
     image_embedding_size = image_size // vit_patch_size
     sam = Sam(
         image_encoder=ImageEncoderViT(
@@ -77,6 +87,7 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+            attn_impl=attn_impl,
         ),
         prompt_encoder=PromptEncoder(
             embed_dim=prompt_embed_dim,
@@ -103,5 +114,34 @@ def _build_sam(
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
             state_dict = torch.load(f)
+        state_dict = resample_positional_embeddings(state_dict, sam.state_dict())
         sam.load_state_dict(state_dict)
     return sam
+
+
+def resample_positional_embeddings(
+    state_dict: Dict[str, torch.Tensor], model_state_dict: Dict[str, torch.Tensor]
+) -> Dict[str, torch.Tensor]:
+    """
+    Resamples the absolute and relative positional embeddings of the image
+    encoder in state_dict to the shapes in model_state_dict, so a checkpoint
+    trained at one image size can be loaded into a model built for another.
+    Other entries are returned unchanged.
+    """
+    state_dict = dict(state_dict)
+    for k, v in state_dict.items():
+        if k not in model_state_dict or model_state_dict[k].shape == v.shape:
+            continue
+        if k == "image_encoder.pos_embed":
+            # 1xHxWxC, resampled like an image
+            size = model_state_dict[k].shape[1:3]
+            v = F.interpolate(
+                v.permute(0, 3, 1, 2), size=size, mode="bicubic", align_corners=False
+            )
+            state_dict[k] = v.permute(0, 2, 3, 1)
+        elif k.endswith("rel_pos_h") or k.endswith("rel_pos_w"):
+            # LxC, resampled along the relative distance axis like in get_rel_pos
+            size = model_state_dict[k].shape[0]
+            v = F.interpolate(v.t()[None], size=size, mode="linear", align_corners=False)
+            state_dict[k] = v[0].t()
+    return state_dict
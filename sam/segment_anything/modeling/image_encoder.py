@@ -33,6 +33,7 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attn_impl: str = "default",
     ) -> None:
         """
         Args:
@@ -51,6 +52,7 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attn_impl (str): Attention kernel, in ['default', 'sdpa', 'chunked']. See Attention.
         """
         super().__init__()
         self.img_size = img_size
@@ -82,6 +84,7 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_impl=attn_impl,
             )
             self.blocks.append(block)
 
@@ -131,6 +134,7 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_impl: str = "default",
     ) -> None:
         """
         Args:
@@ -146,6 +150,7 @@ class Block(nn.Module):
                 use global attention.
             input_size (int or None): Input resolution for calculating the relative positional
                 parameter size.
+            attn_impl (str): Attention kernel, in ['default', 'sdpa', 'chunked']. See Attention.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -156,6 +161,7 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            attn_impl=attn_impl,
         )
 
         self.norm2 = norm_layer(dim)
@@ -193,6 +199,8 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_impl: str = "default",
+        attn_chunk_size: int = 1024,
     ) -> None:
         """
         Args:
@@ -203,8 +211,22 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (int or None): Input resolution for calculating the relative positional
                 parameter size.
+            attn_impl (str): Attention kernel. 'default' materializes the full attention map.
+                'sdpa' uses torch's scaled_dot_product_attention with the relative positions
+                as an additive mask. That mask is the full (B * nHead, H * W, H * W) bias, so
+                'sdpa' only saves memory without relative positions. 'chunked' does the same
+                for blocks of query rows, so only one block of the attention map and mask is
+                in memory at a time.
+            attn_chunk_size (int): Approximate number of query tokens per block for 'chunked'.
         """
         super().__init__()
+        assert attn_impl in [
+            "default",
+            "sdpa",
+            "chunked",
+        ], f"attn_impl must be in ['default', 'sdpa', 'chunked'], is {attn_impl}."
+        self.attn_impl = attn_impl
+        self.attn_chunk_size = attn_chunk_size
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
@@ -228,6 +250,11 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
+        if self.attn_impl != "default":
+            x = self._blockwise_attention(q, k, v, H, W)
+            x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+            return self.proj(x)
+
         attn = (q * self.scale) @ k.transpose(-2, -1)
 
         if self.use_rel_pos:
@@ -239,6 +266,54 @@ class Attention(nn.Module):
 
         return x
 
+    def _blockwise_attention(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, H: int, W: int
+    ) -> torch.Tensor:
+        """
+        Attention over blocks of query rows, with the decomposed relative
+        positions passed as an additive mask. Uses a single block for 'sdpa'.
+        Returns the attention output with shape (B * nHead, H * W, C).
+        """
+        BH, _, C = q.shape
+        if self.use_rel_pos:
+            Rh = get_rel_pos(H, H, self.rel_pos_h)
+            Rw = get_rel_pos(W, W, self.rel_pos_w)
+        rows = H if self.attn_impl == "sdpa" else max(1, self.attn_chunk_size // W)
+
+        q = q.view(BH, H, W, C)
+        out = []
+        for r in range(0, H, rows):
+            q_block = q[:, r : r + rows]
+            bias = None
+            if self.use_rel_pos:
+                bias = get_decomposed_rel_pos_bias(q_block, Rh[r : r + rows], Rw)
+            out.append(
+                scaled_dot_product_attention(q_block.reshape(BH, -1, C), k, v, bias, self.scale)
+            )
+        return out[0] if len(out) == 1 else torch.cat(out, dim=1)
+
+
+def scaled_dot_product_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    scale: float,
+) -> torch.Tensor:
+    """
+    softmax(q @ k^T * scale + bias) @ v, using torch's fused kernels when
+    available (torch>=2.0).
+    """
+    if hasattr(F, "scaled_dot_product_attention"):
+        # The default scale of scaled_dot_product_attention is head_dim**-0.5
+        if scale != q.shape[-1] ** -0.5:
+            q = q * (scale * q.shape[-1] ** 0.5)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+    attn = (q * scale) @ k.transpose(-2, -1)
+    if bias is not None:
+        attn = attn + bias
+    return attn.softmax(dim=-1) @ v
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -361,6 +436,31 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def get_decomposed_rel_pos_bias(
+    r_q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Calculate the decomposed relative positional embeddings of add_decomposed_rel_pos
+    as an additive attention bias, for a block of query rows.
+    Args:
+        r_q (Tensor): query q with shape (B, q_rows, q_w, C).
+        Rh (Tensor): relative positional embeddings of the query rows (q_rows, k_h, C),
+            as returned by get_rel_pos.
+        Rw (Tensor): relative positional embeddings for the width axis (q_w, k_w, C).
+
+    Returns:
+        bias (Tensor): attention bias with shape (B, q_rows * q_w, k_h * k_w).
+    """
+    B, q_rows, q_w, _ = r_q.shape
+    k_h, k_w = Rh.shape[1], Rw.shape[1]
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    bias = rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]
+    return bias.reshape(B, q_rows * q_w, k_h * k_w)
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
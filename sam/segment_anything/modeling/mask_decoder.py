@@ -122,11 +122,22 @@ class MaskDecoder(nn.Module):
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
-        src = src + dense_prompt_embeddings
-        pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
+        # Expand per-image data in batch direction to be per-mask. A single
+        # image is broadcast to all prompts instead of being copied per prompt.
+        # Dense embeddings that are the same for all prompts (the no-mask
+        # embedding, expanded) are added once; per-prompt mask embeddings
+        # still give one copy per prompt. The transformer's first layer makes
+        # per-prompt keys in any case, so this only saves the copies made here.
+        if image_embeddings.shape[0] == 1:
+            if dense_prompt_embeddings.stride(0) == 0:
+                dense_prompt_embeddings = dense_prompt_embeddings[:1]
+            src = image_embeddings + dense_prompt_embeddings
+            src = src.expand(tokens.shape[0], -1, -1, -1)
+        else:
+            src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
+            src = src + dense_prompt_embeddings
         b, c, h, w = src.shape
+        pos_src = image_pe.expand(b, -1, -1, -1)
 
         # Run the transformer
         hs, src = self.transformer(src, pos_src, tokens)
@@ -8,7 +8,7 @@ import numpy as np
 import torch
 from torch import nn
 
-from typing import Any, Optional, Tuple, Type
+from typing import Any, Dict, Optional, Tuple, Type
 
 from .common import LayerNorm2d
 
@@ -58,17 +58,33 @@ class PromptEncoder(nn.Module):
             nn.Conv2d(mask_in_chans, embed_dim, kernel_size=1),
         )
         self.no_mask_embed = nn.Embedding(1, embed_dim)
+        self._dense_pe_cache: Dict[Tuple[Any, ...], torch.Tensor] = {}
 
     def get_dense_pe(self) -> torch.Tensor:
         """
         Returns the positional encoding used to encode point prompts,
         applied to a dense set of points the shape of the image encoding.
+        The encoding is computed once per embedding size and device, and
+        recomputed if the random frequencies are changed, e.g. by loading
+        a checkpoint.
 
         Returns:
           torch.Tensor: Positional encoding with shape
             1x(embed_dim)x(embedding_h)x(embedding_w)
         """
-        return self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        gaussian_matrix = self.pe_layer.positional_encoding_gaussian_matrix
+        key = (
+            tuple(self.image_embedding_size),
+            gaussian_matrix.device,
+            gaussian_matrix.data_ptr(),
+            gaussian_matrix._version,
+        )
+        dense_pe = self._dense_pe_cache.get(key)
+        if dense_pe is None:
+            with torch.no_grad():
+                dense_pe = self.pe_layer(self.image_embedding_size).unsqueeze(0)
+            self._dense_pe_cache = {key: dense_pe}
+        return dense_pe
 
     def _embed_points(
         self,
@@ -14,6 +14,22 @@ from typing import Optional, Tuple
 from .utils.transforms import ResizeLongestSide
 
 
+def image_as_tensor(image: np.ndarray, device: torch.device) -> Tuple[torch.Tensor, bool]:
+    """
+    Wraps an HWC image as a tensor without copying it on the host. torch
+    cannot wrap negative strides, so a channel-reversed view such as
+    image[:, :, ::-1] is wrapped in its original channel order, and the
+    returned flag tells that its channels have to be read in reverse order.
+    """
+    flipped = image.strides[2] < 0
+    if flipped:
+        image = image[:, :, ::-1]
+    if any(stride < 0 for stride in image.strides):
+        # Other reversed axes are rare, these images are copied
+        image = np.ascontiguousarray(image)
+    return torch.as_tensor(image, device=device), flipped
+
+
 class SamPredictor:
     def __init__(
         self,
@@ -29,6 +45,7 @@ class SamPredictor:
         super().__init__()
         self.model = sam_model
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
+        self.input_buffer: Optional[torch.Tensor] = None
         self.reset_image()
 
     def set_image(
@@ -49,21 +66,27 @@ class SamPredictor:
             "RGB",
             "BGR",
         ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
-        if image_format != self.model.image_format:
-            image = image[..., ::-1]
 
-        # Transform the image to the form expected by the model
-        input_image = self.transform.apply_image(image)
-        input_image_torch = torch.as_tensor(input_image, device=self.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
-
-        self.set_torch_image(input_image_torch, image.shape[:2])
+        # Transform the image to the form expected by the model. The uint8 image
+        # is resized as a tensor on the device, and a different color format or
+        # a channel-reversed view is handled when normalizing, so the image is
+        # not copied on the host.
+        input_image_torch, flipped = image_as_tensor(image, self.device)
+        input_image_torch = input_image_torch.permute(2, 0, 1)[None, :, :, :]
+        input_image_torch = self.transform.apply_image_torch(input_image_torch)
+
+        self.set_torch_image(
+            input_image_torch,
+            image.shape[:2],
+            flip_channels=(image_format != self.model.image_format) != flipped,
+        )
 
     @torch.no_grad()
     def set_torch_image(
         self,
         transformed_image: torch.Tensor,
         original_image_size: Tuple[int, ...],
+        flip_channels: bool = False,
     ) -> None:
         """
         Calculates the image embeddings for the provided image, allowing
@@ -75,6 +98,8 @@ class SamPredictor:
             1x3xHxW, which has been transformed with ResizeLongestSide.
           original_image_size (tuple(int, int)): The size of the image
             before transformation, in (H, W) format.
+          flip_channels (bool): If true, the color channels of the input
+            image are in reverse order, e.g. BGR for an RGB model.
         """
         assert (
             len(transformed_image.shape) == 4
@@ -85,7 +110,9 @@ class SamPredictor:
 
         self.original_size = original_image_size
         self.input_size = tuple(transformed_image.shape[-2:])
-        input_image = self.model.preprocess(transformed_image)
+        input_image = self.get_input_buffer(transformed_image.shape[0])
+        for i in range(transformed_image.shape[0]):
+            self.preprocess_into(transformed_image[i], input_image[i], flip_channels)
         self.features = self.model.image_encoder(input_image)
         self.is_image_set = True
 
@@ -174,6 +201,7 @@ class SamPredictor:
         mask_input: Optional[torch.Tensor] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
+        upscale_masks: bool = True,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
@@ -200,10 +228,14 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          upscale_masks (bool): If false, the output masks are left at the
+            low resolution of the mask decoder instead of being upscaled to
+            the original image size. Padding is not removed in this case.
 
         Returns:
           (torch.Tensor): The output masks in BxCxHxW format, where C is the
-            number of masks, and (H, W) is the original image size.
+            number of masks, and (H, W) is the original image size, or the
+            low resolution size if upscale_masks is false.
           (torch.Tensor): An array of shape BxC containing the model's
             predictions for the quality of each mask.
           (torch.Tensor): An array of shape BxCxHxW, where C is the number
@@ -235,7 +267,10 @@ class SamPredictor:
         )
 
         # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if upscale_masks:
+            masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        else:
+            masks = low_res_masks
 
         if not return_logits:
             masks = masks > self.model.mask_threshold
@@ -255,10 +290,68 @@ class SamPredictor:
         assert self.features is not None, "Features must exist if an image has been set."
         return self.features
 
+    def set_image_embedding(
+        self,
+        features: torch.Tensor,
+        original_image_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets precomputed image embeddings, allowing masks to be predicted
+        with the 'predict' method without running the image encoder.
+
+        Arguments:
+          features (torch.Tensor): The image embeddings, with shape 1xCxHxW,
+            as returned by the image encoder.
+          original_image_size (tuple(int, int)): The size of the image
+            before transformation, in (H, W) format.
+          input_size (tuple(int, int)): The size of the image after
+            ResizeLongestSide and before padding, in (H, W) format.
+        """
+        assert (
+            len(features.shape) == 4 and features.shape[0] == 1
+        ), "set_image_embedding input must have shape 1xCxHxW."
+        self.reset_image()
+
+        self.original_size = tuple(original_image_size)
+        self.input_size = tuple(input_size)
+        self.features = features
+        self.is_image_set = True
+
     @property
     def device(self) -> torch.device:
         return self.model.device
 
+    def get_input_buffer(self, batch_size: int = 1) -> torch.Tensor:
+        """
+        Returns a Bx3xSxS input buffer for the image encoder, where S is its
+        input size. The buffer is allocated once and reused across images.
+        """
+        img_size = self.model.image_encoder.img_size
+        if (
+            self.input_buffer is None
+            or self.input_buffer.shape[0] < batch_size
+            or self.input_buffer.device != self.device
+        ):
+            self.input_buffer = torch.zeros(batch_size, 3, img_size, img_size, device=self.device)
+        return self.input_buffer[:batch_size]
+
+    def preprocess_into(
+        self, image: torch.Tensor, out: torch.Tensor, flip_channels: bool = False
+    ) -> None:
+        """
+        Normalizes a 3xHxW image resized with ResizeLongestSide into a 3xSxS
+        slot of the input buffer and zeroes the padding, like Sam.preprocess
+        but in place. If flip_channels, the channels are read in reverse order.
+        """
+        h, w = image.shape[-2:]
+        out[:, h:, :].zero_()
+        out[:, :h, w:].zero_()
+        for c in range(3):
+            src = 2 - c if flip_channels else c
+            out[c, :h, :w].copy_(image[src])
+            out[c, :h, :w].sub_(self.model.pixel_mean[c]).div_(self.model.pixel_std[c])
+
     def reset_image(self) -> None:
         """Resets the currently set image."""
         self.is_image_set = False
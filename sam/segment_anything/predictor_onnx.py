@@ -0,0 +1,222 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from .predictor import SamPredictor
+
+
+class OnnxImageEncoder:
+    """
+    Runs the image encoder exported by scripts/export_onnx_model.py with
+    onnxruntime. Takes and returns torch tensors, like ImageEncoderViT.
+    """
+
+    def __init__(self, session) -> None:
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.img_size = session.get_inputs()[0].shape[-1]
+        # Models exported with a fixed batch size are run one image at a time
+        self.batched = not isinstance(session.get_inputs()[0].shape[0], int)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.detach().cpu().numpy().astype(np.float32)
+        if self.batched:
+            out = self.session.run(None, {self.input_name: x})[0]
+        else:
+            out = np.concatenate(
+                [self.session.run(None, {self.input_name: x[i : i + 1]})[0] for i in range(len(x))]
+            )
+        return torch.from_numpy(out)
+
+
+class OnnxSam:
+    """
+    Stands in for Sam when the image encoder and the prompt encoder plus
+    mask decoder are run as ONNX models with onnxruntime's CPU provider.
+    Provides the parts of Sam used by SamOnnxPredictor and
+    SamAutomaticMaskGenerator.
+    """
+
+    mask_threshold: float = 0.0
+    image_format: str = "RGB"
+
+    def __init__(
+        self,
+        encoder_path: str,
+        decoder_path: str,
+        num_threads: Optional[int] = None,
+        pixel_mean: List[float] = [123.675, 116.28, 103.53],
+        pixel_std: List[float] = [58.395, 57.12, 57.375],
+    ) -> None:
+        """
+        Arguments:
+          encoder_path (str): The image encoder ONNX model, exported with
+            --encoder-output in scripts/export_onnx_model.py.
+          decoder_path (str): The prompt encoder and mask decoder ONNX model,
+            exported without --return-single-mask.
+          num_threads (int or None): The number of threads onnxruntime uses
+            within an operator. If None, onnxruntime picks it.
+          pixel_mean (list(float)): Mean values for normalizing pixels in the input image.
+          pixel_std (list(float)): Std values for normalizing pixels in the input image.
+        """
+        import onnxruntime  # type: ignore
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.image_encoder = OnnxImageEncoder(
+            onnxruntime.InferenceSession(encoder_path, options, providers=providers)
+        )
+        self.decoder_session = onnxruntime.InferenceSession(
+            decoder_path, options, providers=providers
+        )
+        decoder_inputs = {i.name: i for i in self.decoder_session.get_inputs()}
+        self.decoder_batched = not isinstance(decoder_inputs["point_coords"].shape[0], int)
+        self.prompt_encoder = SimpleNamespace(
+            mask_input_size=tuple(decoder_inputs["mask_input"].shape[-2:])
+        )
+        self.mask_decoder = SimpleNamespace(num_multimask_outputs=3)
+        self.pixel_mean = torch.Tensor(pixel_mean).view(-1, 1, 1)
+        self.pixel_std = torch.Tensor(pixel_std).view(-1, 1, 1)
+
+    @property
+    def device(self) -> torch.device:
+        return self.pixel_mean.device
+
+    def decode(self, inputs: Dict[str, np.ndarray]) -> Tuple[np.ndarray, ...]:
+        """
+        Runs the decoder model. Returns the upscaled masks, the IoU predictions
+        and the low resolution masks, for all four mask outputs.
+        """
+        if self.decoder_batched:
+            return tuple(self.decoder_session.run(None, inputs))
+        # Run prompts one at a time for models exported with a fixed batch size
+        batched_inputs = ["point_coords", "point_labels", "mask_input"]
+        outputs = []
+        for i in range(len(inputs["point_coords"])):
+            single_inputs = {
+                k: v[i : i + 1] if k in batched_inputs else v for k, v in inputs.items()
+            }
+            outputs.append(self.decoder_session.run(None, single_inputs))
+        return tuple(np.concatenate(o, axis=0) for o in zip(*outputs))
+
+    def preprocess(self, x: torch.Tensor) -> torch.Tensor:
+        """Normalize pixel values and pad to a square input."""
+        x = (x - self.pixel_mean) / self.pixel_std
+        h, w = x.shape[-2:]
+        padh = self.image_encoder.img_size - h
+        padw = self.image_encoder.img_size - w
+        x = F.pad(x, (0, padw, 0, padh))
+        return x
+
+    def postprocess_masks(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+    ) -> torch.Tensor:
+        """Remove padding and upscale masks to the original image size."""
+        masks = F.interpolate(
+            masks,
+            (self.image_encoder.img_size, self.image_encoder.img_size),
+            mode="bilinear",
+            align_corners=False,
+        )
+        masks = masks[..., : input_size[0], : input_size[1]]
+        masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
+        return masks
+
+
+class SamOnnxPredictor(SamPredictor):
+    def __init__(
+        self,
+        sam_model: OnnxSam,
+    ) -> None:
+        """
+        SamPredictor that runs the image encoder and the mask decoder with
+        onnxruntime. Has the same API as SamPredictor, and can be passed to
+        SamAutomaticMaskGenerator in place of a model.
+
+        Arguments:
+          sam_model (OnnxSam): The ONNX models to use for mask prediction.
+        """
+        super().__init__(sam_model)
+
+    @torch.no_grad()
+    def predict_torch(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        upscale_masks: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Predict masks for the given input prompts, using the currently set image.
+        See SamPredictor.predict_torch.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        # Boxes are given to the ONNX model as two corner points with labels 2 and 3.
+        # Without a box, a padding point with label -1 is added instead.
+        coords, labels = [], []
+        if point_coords is not None:
+            coords.append(point_coords.float())
+            labels.append(point_labels.float())
+        if coords:
+            batch_size = coords[0].shape[0]
+        elif boxes is not None:
+            batch_size = boxes.shape[0]
+        elif mask_input is not None:
+            batch_size = mask_input.shape[0]
+        else:
+            batch_size = 1
+        if boxes is not None:
+            coords.append(boxes.reshape(-1, 2, 2).float())
+            labels.append(torch.tensor([[2.0, 3.0]]).expand(batch_size, 2))
+        else:
+            coords.append(torch.zeros(batch_size, 1, 2))
+            labels.append(-torch.ones(batch_size, 1))
+
+        has_mask_input = mask_input is not None
+        if mask_input is None:
+            mask_input = torch.zeros(batch_size, 1, *self.model.prompt_encoder.mask_input_size)
+
+        masks, iou_predictions, low_res_masks = self.model.decode(
+            {
+                "image_embeddings": self.features.cpu().numpy().astype(np.float32),
+                "point_coords": torch.cat(coords, dim=1).cpu().numpy(),
+                "point_labels": torch.cat(labels, dim=1).cpu().numpy(),
+                "mask_input": mask_input.float().cpu().numpy(),
+                "has_mask_input": np.array([float(has_mask_input)], dtype=np.float32),
+                "orig_im_size": np.array(self.original_size, dtype=np.float32),
+            }
+        )
+
+        # The first output is the single mask output, the others the multimask outputs
+        outputs = slice(1, None) if multimask_output else slice(0, 1)
+        masks = torch.from_numpy(masks[:, outputs])
+        iou_predictions = torch.from_numpy(iou_predictions[:, outputs])
+        low_res_masks = torch.from_numpy(low_res_masks[:, outputs])
+
+        if not upscale_masks:
+            masks = low_res_masks
+
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+
+        return masks, iou_predictions, low_res_masks
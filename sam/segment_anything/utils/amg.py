@@ -8,9 +8,10 @@ import numpy as np
 import torch
 
 import math
+import os
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 
 class MaskData:
@@ -104,6 +105,104 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
         yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
 
 
+def is_out_of_memory_error(error: BaseException) -> bool:
+    """Checks if an error was raised by running out of GPU or CPU memory."""
+    if isinstance(error, MemoryError):
+        return True
+    if not isinstance(error, RuntimeError):
+        return False
+    message = str(error)
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def available_memory(device: torch.device, memory_limit: Optional[int] = None) -> int:
+    """
+    Returns the number of bytes that can still be allocated on device. On
+    GPU, this is the free device memory. On CPU, it is memory_limit minus
+    the resident set size of the process, or the memory available to the
+    system if no limit is given. The result is capped by memory_limit.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free if memory_limit is None else min(free, memory_limit)
+
+    try:
+        import psutil  # type: ignore
+
+        rss = psutil.Process().memory_info().rss
+        system_available = psutil.virtual_memory().available
+    except ImportError:
+        # Fall back to procfs, only present on Linux
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            with open("/proc/meminfo") as f:
+                meminfo = dict(line.split(":", 1) for line in f)
+            system_available = int(meminfo["MemAvailable"].split()[0]) * 1024
+        except (OSError, KeyError, ValueError):
+            rss, system_available = 0, None
+    if memory_limit is None:
+        return system_available if system_available is not None else 2**34
+    available = memory_limit - rss
+    if system_available is not None:
+        available = min(available, system_available)
+    return max(available, 0)
+
+
+class AdaptiveBatchSize:
+    """
+    Chooses how many prompts to run through the mask decoder at once. A
+    fixed batch size is kept as given. Otherwise, the batch size is capped
+    by the memory available for the decoder outputs, and is doubled as long
+    as doing so lowers the measured latency per prompt. In both cases, the
+    batch size is halved after running out of memory.
+    """
+
+    def __init__(
+        self,
+        batch_size: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+        initial_batch_size: int = 64,
+        max_batch_size: int = 1024,
+    ) -> None:
+        self.adaptive = batch_size is None
+        self.memory_limit = memory_limit
+        self.max_batch_size = max_batch_size
+        self.batch_size = initial_batch_size if batch_size is None else batch_size
+        self.oom_cap = max_batch_size if batch_size is None else batch_size
+        self.memory_cap = self.oom_cap
+        self.best_latency: Optional[float] = None
+        self.converged = False
+
+    def reset(self, bytes_per_prompt: int, device: torch.device) -> None:
+        """Prepares for a new image, given the memory one prompt needs on device."""
+        if self.adaptive:
+            available = available_memory(device, self.memory_limit)
+            self.memory_cap = int(min(self.max_batch_size, available // max(bytes_per_prompt, 1)))
+            self.memory_cap = max(self.memory_cap, 1)
+            self.best_latency = None
+            self.converged = False
+        self.batch_size = max(min(self.batch_size, self.memory_cap, self.oom_cap), 1)
+
+    def update(self, n_prompts: int, seconds: float) -> None:
+        """Records the latency of a batch and grows the batch size if it paid off."""
+        if not self.adaptive or self.converged or n_prompts < self.batch_size:
+            return
+        latency = seconds / n_prompts
+        if self.best_latency is None or latency < 0.9 * self.best_latency:
+            self.best_latency = latency
+            self.batch_size = min(2 * self.batch_size, self.memory_cap, self.oom_cap)
+        else:
+            self.converged = True
+
+    def backoff(self) -> None:
+        """Halves the batch size after running out of memory."""
+        self.batch_size = max(self.batch_size // 2, 1)
+        self.oom_cap = self.batch_size
+        self.converged = True
+
+
 def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     """
     Encodes masks to an uncompressed RLE, in the format expected by
@@ -82,7 +82,8 @@ class SamOnnxModel(nn.Module):
         )
 
         prepadded_size = self.resize_longest_image_size(orig_im_size, self.img_size)
-        masks = masks[..., : int(prepadded_size[0]), : int(prepadded_size[1])]
+        # Slice with tensors, so the crop is not traced as a constant for the dummy input size
+        masks = masks[..., : prepadded_size[0], : prepadded_size[1]]
 
         orig_im_size = orig_im_size.to(torch.int64)
         h, w = orig_im_size[0], orig_im_size[1]
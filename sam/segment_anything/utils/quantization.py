@@ -0,0 +1,70 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic
+
+import os
+from typing import Optional
+
+from ..modeling import Sam
+
+
+def quantize_sam(sam: Sam) -> Sam:
+    """
+    Applies dynamic int8 quantization to the nn.Linear layers of the image
+    encoder blocks and of the mask decoder's two-way transformer. Weights
+    are stored in int8, activations are quantized on the fly. Quantized
+    models only run on CPU. Edits sam in place and returns it.
+    """
+    sam.image_encoder.blocks = quantize_dynamic(
+        sam.image_encoder.blocks, {nn.Linear}, dtype=torch.qint8
+    )
+    sam.mask_decoder.transformer = quantize_dynamic(
+        sam.mask_decoder.transformer, {nn.Linear}, dtype=torch.qint8
+    )
+    return sam
+
+
+def build_quantized_sam(
+    model_type: str,
+    checkpoint: Optional[str] = None,
+    quantized_checkpoint: Optional[str] = None,
+    **kwargs,
+) -> Sam:
+    """
+    Builds a dynamically quantized SAM model for CPU inference.
+
+    Arguments:
+      model_type (str): The type of model, in ['default', 'vit_h', 'vit_l', 'vit_b'].
+      checkpoint (str or None): The path to the fp32 SAM checkpoint.
+      quantized_checkpoint (str or None): The path of the on-disk cache of
+        the quantized weights. If it exists, the quantized weights are loaded
+        from it and the fp32 checkpoint is not read. Otherwise, the fp32
+        checkpoint is quantized and the result is saved there.
+      **kwargs: Extra arguments to the sam_model_registry builder.
+
+    Returns:
+      (Sam): The quantized model, in eval mode.
+    """
+    from ..build_sam import sam_model_registry
+
+    if quantized_checkpoint is not None and os.path.exists(quantized_checkpoint):
+        sam = quantize_sam(sam_model_registry[model_type](**kwargs))
+        with open(quantized_checkpoint, "rb") as f:
+            state_dict = torch.load(f)
+        sam.load_state_dict(state_dict)
+        return sam
+
+    sam = quantize_sam(sam_model_registry[model_type](checkpoint=checkpoint, **kwargs))
+    if quantized_checkpoint is not None:
+        # Write to a temporary file first, so an interrupted save is never loaded
+        tmp_path = quantized_checkpoint + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(sam.state_dict(), f)
+        os.replace(tmp_path, quantized_checkpoint)
+    return sam
@@ -54,12 +54,16 @@ class ResizeLongestSide:
 
     def apply_image_torch(self, image: torch.Tensor) -> torch.Tensor:
         """
-        Expects batched images with shape BxCxHxW and float format. This
-        transformation may not exactly match apply_image. apply_image is
-        the transformation expected by the model.
+        Expects batched images with shape BxCxHxW in uint8 or float format.
+        uint8 images on CPU are resized without a float copy and stay uint8,
+        as with apply_image. This transformation may not exactly match
+        apply_image. apply_image is the transformation expected by the model.
         """
         # Expects an image in BCHW format. May not exactly match apply_image.
-        target_size = self.get_preprocess_shape(image.shape[0], image.shape[1], self.target_length)
+        target_size = self.get_preprocess_shape(image.shape[2], image.shape[3], self.target_length)
+        if not torch.is_floating_point(image) and image.device.type != "cpu":
+            # uint8 interpolation is only implemented on CPU
+            image = image.float()
         return F.interpolate(
             image, target_size, mode="bilinear", align_corners=False, antialias=True
         )
@@ -8,6 +8,7 @@ import torch
 import gc
 import imageio
 from scipy.ndimage import binary_dilation
+from tool.embedding_cache import files_fingerprint
 
 def save_prediction(pred_mask,output_dir,file_name):
     save_mask = Image.fromarray(pred_mask.astype(np.uint8))
@@ -92,6 +93,8 @@ def video_type_input_tracking(SegTracker, input_video):
     gc.collect()
     sam_gap = SegTracker.sam_gap
     frame_idx = 0
+    # frames are keyed by video and index in the on-disk embedding cache, so re-runs skip the image encoder
+    video_key = files_fingerprint([input_video]) if SegTracker.sam.disk_cache is not None else None
 
     with torch.cuda.amp.autocast():
         while cap.isOpened():
@@ -105,10 +108,12 @@ def video_type_input_tracking(SegTracker, input_video):
                 frame_idx += 1
                 continue
             elif (frame_idx % sam_gap) == 0:
-                seg_mask = SegTracker.seg(frame)
+                track_mask = SegTracker.track(frame)
+                prior_mask = track_mask if SegTracker.sam_warm_start else None
+                frame_key = None if video_key is None else (video_key, frame_idx)
+                seg_mask = SegTracker.seg(frame, prior_mask, frame_key)
                 torch.cuda.empty_cache()
                 gc.collect()
-                track_mask = SegTracker.track(frame)
                 # find new objects, and update tracker with new objects
                 new_obj_mask = SegTracker.find_new_objs(track_mask,seg_mask)
                 save_prediction(new_obj_mask,output_dir,str(frame_idx)+'_new.png')
@@ -188,6 +193,8 @@ def img_seq_type_input_tracking(SegTracker, input_img_seq, fps):
     file_name = input_img_seq.name.split('/')[-1].split('.')[0]
     file_path = f'./assets/{file_name}'
     imgs_path = sorted([os.path.join(file_path, img_name) for img_name in os.listdir(file_path)])
+    # frames are keyed by image sequence and index in the on-disk embedding cache, so re-runs skip the image encoder
+    video_key = files_fingerprint(imgs_path) if SegTracker.sam.disk_cache is not None else None
 
     video_name = file_name
     io_args = {
@@ -218,10 +225,12 @@ def img_seq_type_input_tracking(SegTracker, input_img_seq, fps):
                 frame_idx += 1
                 continue
             elif (frame_idx % sam_gap) == 0:
-                seg_mask = SegTracker.seg(frame)
+                track_mask = SegTracker.track(frame)
+                prior_mask = track_mask if SegTracker.sam_warm_start else None
+                frame_key = None if video_key is None else (video_key, frame_idx)
+                seg_mask = SegTracker.seg(frame, prior_mask, frame_key)
                 torch.cuda.empty_cache()
                 gc.collect()
-                track_mask = SegTracker.track(frame)
                 # find new objects, and update tracker with new objects
                 new_obj_mask = SegTracker.find_new_objs(track_mask,seg_mask)
                 save_prediction(new_obj_mask,output_dir,str(frame_idx)+'_new.png')
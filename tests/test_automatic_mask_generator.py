@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.build_sam import _build_sam
+
+BOXES = [(10, 15, 60, 70), (70, 20, 150, 55), (90, 70, 140, 110), (20, 85, 55, 112)]
+
+
+def _label_map(h=120, w=160):
+    labels = np.zeros((h, w), dtype=np.int64)
+    for idx, (x0, y0, x1, y1) in enumerate(BOXES, start=1):
+        labels[y0:y1, x0:x1] = idx
+    return labels
+
+
+def _image(labels):
+    rng = np.random.RandomState(0)
+    colors = rng.randint(0, 255, (len(BOXES) + 1, 3)).astype(np.uint8)
+    return colors[labels]
+
+
+@pytest.fixture(scope="module")
+def sam():
+    torch.manual_seed(0)
+    return _build_sam(
+        encoder_embed_dim=32,
+        encoder_depth=2,
+        encoder_num_heads=2,
+        encoder_global_attn_indexes=[1],
+        image_size=256,
+    ).eval()
+
+
+def _object_decoder(sam, labels, monkeypatch):
+    """
+    Makes the mask decoder of sam predict smooth logits of the object under
+    each point prompt, so that the generated masks are known.
+    """
+    h, w = labels.shape
+    low_res = sam.prompt_encoder.mask_input_size[0]
+    # The low res logits cover the resized image and its padding
+    scale = low_res / max(h, w)
+    grid = np.arange(low_res)
+    ys = np.minimum(((grid + 0.5) / scale).astype(int), h - 1)
+    xs = np.minimum(((grid + 0.5) / scale).astype(int), w - 1)
+    low_res_labels = torch.as_tensor(labels[ys[:, None], xs[None, :]])
+    padding = (grid[:, None] >= h * scale) | (grid[None, :] >= w * scale)
+    low_res_labels[torch.as_tensor(padding)] = -1
+
+    prompt_encoder, recorded = sam.prompt_encoder.forward, []
+
+    def record_points(points, boxes, masks):
+        recorded.append(points[0][:, 0])
+        return prompt_encoder(points=points, boxes=boxes, masks=masks)
+
+    def decode(image_embeddings, image_pe, sparse_prompt_embeddings, **kwargs):
+        coords = (recorded.pop() * low_res / sam.image_encoder.img_size).long()
+        obj = low_res_labels[coords[:, 1], coords[:, 0]]
+        logits = torch.where(low_res_labels[None] == obj[:, None, None], 8.0, -8.0)
+        logits = F.avg_pool2d(logits[:, None], 5, stride=1, padding=2, count_include_pad=False)
+        # Two stable nested masks and a faint, unstable mask of the whole
+        # frame with the best predicted IoU, which the stability score
+        # filter has to remove
+        masks = torch.cat([logits, torch.full_like(logits, 0.5), logits + 2.0], dim=1)
+        return masks, torch.tensor([[0.95, 0.99, 0.9]]).expand(len(obj), -1)
+
+    monkeypatch.setattr(sam.prompt_encoder, "forward", record_points)
+    monkeypatch.setattr(sam.mask_decoder, "forward", decode)
+
+
+def _iou(a, b):
+    return np.logical_and(a, b).sum() / max(np.logical_or(a, b).sum(), 1)
+
+
+def test_low_res_filtering_matches_full_resolution(sam, monkeypatch):
+    labels = _label_map()
+    image = _image(labels)
+    _object_decoder(sam, labels, monkeypatch)
+
+    masks = {}
+    for low_res_filtering in [False, True]:
+        generator = SamAutomaticMaskGenerator(
+            sam,
+            points_per_side=12,
+            # Low res stability scores are approximate, so the threshold is
+            # far from the scores of both the stable and the flat masks
+            stability_score_thresh=0.5,
+            low_res_filtering=low_res_filtering,
+        )
+        masks[low_res_filtering] = [m["segmentation"] for m in generator.generate(image)]
+
+    # One mask per object and one for the background
+    assert len(masks[True]) == len(masks[False]) == len(BOXES) + 1
+    for mask in masks[False]:
+        assert max(_iou(mask, other) for other in masks[True]) > 0.95
+
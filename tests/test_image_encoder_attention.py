@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from segment_anything.modeling.image_encoder import Attention, ImageEncoderViT
+
+
+def _attention(attn_impl, use_rel_pos=True):
+    torch.manual_seed(0)
+    attn = Attention(32, num_heads=4, use_rel_pos=use_rel_pos, rel_pos_zero_init=False,
+                     input_size=(12, 10), attn_impl=attn_impl, attn_chunk_size=24)
+    if use_rel_pos:
+        torch.nn.init.normal_(attn.rel_pos_h, std=0.5)
+        torch.nn.init.normal_(attn.rel_pos_w, std=0.5)
+    return attn.eval()
+
+
+@pytest.mark.parametrize('use_rel_pos', [True, False])
+@pytest.mark.parametrize('attn_impl', ['sdpa', 'chunked'])
+def test_attention_matches_default(attn_impl, use_rel_pos):
+    x = torch.randn(2, 12, 10, 32)
+    with torch.no_grad():
+        expected = _attention('default', use_rel_pos)(x)
+        out = _attention(attn_impl, use_rel_pos)(x)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('attn_impl', ['sdpa', 'chunked'])
+def test_image_encoder_matches_default(attn_impl):
+    def encoder(impl):
+        torch.manual_seed(0)
+        model = ImageEncoderViT(img_size=64, patch_size=8, embed_dim=32, depth=2, num_heads=2,
+                                out_chans=16, use_rel_pos=True, rel_pos_zero_init=False,
+                                window_size=4, global_attn_indexes=(1,), attn_impl=impl)
+        for name, param in model.named_parameters():
+            if 'rel_pos' in name:
+                torch.nn.init.normal_(param, std=0.5)
+        for module in model.modules():
+            if isinstance(module, Attention):
+                # several blocks of query rows also in the windowed layers
+                module.attn_chunk_size = 8
+        return model.eval()
+
+    x = torch.randn(1, 3, 64, 64)
+    with torch.no_grad():
+        expected = encoder('default')(x)
+        out = encoder(attn_impl)(x)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-4)
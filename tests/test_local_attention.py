@@ -0,0 +1,82 @@
+import copy
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from networks.layers.attention import (LocalGatedPropagation,
+                                       MultiheadLocalAttentionV1,
+                                       MultiheadLocalAttentionV2,
+                                       ShiftedWindowCorrelation,
+                                       shifted_window_aggregation)
+
+
+def unfold_window(x, window_size, dilation):
+    n, c, h, w = x.size()
+    pad_pixel = (window_size // 2) * dilation
+    x = F.pad(x, (pad_pixel, pad_pixel, pad_pixel, pad_pixel))
+    return F.unfold(x, kernel_size=window_size,
+                    dilation=dilation).view(n, c, window_size * window_size,
+                                            h, w)
+
+
+@pytest.mark.parametrize('dilation', [1, 2])
+def test_shifted_window_matches_unfold(dilation):
+    torch.manual_seed(0)
+    window_size = 5
+    q, k, v = torch.randn(3, 4, 8, 9, 11).unbind(0)
+
+    qk = ShiftedWindowCorrelation(window_size, dilation)(q, k)
+    expected_qk = (q.unsqueeze(2) *
+                   unfold_window(k, window_size, dilation)).sum(dim=1)
+    torch.testing.assert_close(qk.flatten(1, 2), expected_qk)
+
+    local_attn = torch.softmax(expected_qk, dim=1)
+    output = shifted_window_aggregation(local_attn, v, window_size, dilation)
+    expected = (local_attn.unsqueeze(1) *
+                unfold_window(v, window_size, dilation)).sum(dim=2)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+
+def _with_unfold(module):
+    # The reference path of the same weights: unfolded keys and values
+    reference = copy.deepcopy(module)
+    reference.enable_corr = False
+    reference.shifted_window = False
+    return reference
+
+
+def _with_shifted_window(module):
+    module.correlation_sampler = ShiftedWindowCorrelation(
+        module.window_size, module.dilation)
+    module.shifted_window = True
+    return module
+
+
+# local2global, the unfold path of V2 and the gated propagation, only
+# supports dilation=1
+@pytest.mark.parametrize('attention,dilation', [('v1', 1), ('v1', 2),
+                                                ('v2', 1), ('gated', 1)])
+def test_local_attention_matches_unfold(attention, dilation):
+    torch.manual_seed(0)
+    n, c, h, w = 2, 16, 9, 10
+    if attention == 'v1':
+        module = MultiheadLocalAttentionV1(c, 2, max_dis=3, dilation=dilation)
+    elif attention == 'v2':
+        module = MultiheadLocalAttentionV2(c, 2, max_dis=3, dilation=dilation)
+    else:
+        module = LocalGatedPropagation(c, c, 2, max_dis=3, dilation=dilation)
+    for param in module.parameters():
+        torch.nn.init.normal_(param, std=0.2)
+    module = _with_shifted_window(module.eval())
+    reference = _with_unfold(module)
+
+    q, k, v, u = torch.randn(4, n, c, h, w).unbind(0)
+    with torch.no_grad():
+        if attention == 'gated':
+            output, _ = module(q, k, v, u, (h, w))
+            expected, _ = reference(q, k, v, u, (h, w))
+        else:
+            output, _ = module(q, k, v)
+            expected, _ = reference(q, k, v)
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-5)
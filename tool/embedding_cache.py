@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+def frame_fingerprint(image: np.ndarray) -> str:
+    '''
+    Content hash of a frame, used as its key when no frame index is given.
+    '''
+    image = np.ascontiguousarray(image)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((image.shape, image.dtype.str)).encode())
+    h.update(memoryview(image).cast('B'))
+    return h.hexdigest()
+
+
+def files_fingerprint(paths: List[str], chunk_size: int = 2**16) -> str:
+    '''
+    Hash of a video file or an image sequence, used with frame indices as keys of the on-disk cache.
+    Only the size and the first and last chunk_size bytes of each file are read, so the key costs a few
+    reads instead of reading the whole video, and it does not change when the files are copied or moved.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        size = os.path.getsize(path)
+        h.update(str(size).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read(chunk_size))
+            if size > 2 * chunk_size:
+                f.seek(-chunk_size, os.SEEK_END)
+                h.update(f.read(chunk_size))
+            else:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    '''
+    LRU cache of SAM image embeddings, keyed by frame identity.
+    Each entry is (features, original_size, input_size), as needed by SamPredictor.set_image_embedding.
+    Least recently used entries are evicted once the features take more than max_bytes.
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Hashable, features: torch.Tensor, original_size: Tuple[int, ...], input_size: Tuple[int, ...]):
+        if key in self.entries:
+            self.nbytes -= self._entry_bytes(self.entries.pop(key))
+        entry = (features, tuple(original_size), tuple(input_size))
+        entry_bytes = self._entry_bytes(entry)
+        if entry_bytes > self.max_bytes:
+            return
+        while self.nbytes + entry_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self._entry_bytes(evicted)
+        self.entries[key] = entry
+        self.nbytes += entry_bytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def _entry_bytes(entry) -> int:
+        features = entry[0]
+        return features.numel() * features.element_size()
+
+
+class DiskEmbeddingCache:
+    '''
+    On-disk cache of SAM image embeddings, kept across SegTracker instances and runs.
+    Same interface as EmbeddingCache. Keys are e.g. ((video hash, frame index), crop box).
+    Features are stored as fp16 .npy files, with a .json file holding original_size and input_size.
+    get returns them as fp16 tensors memory-mapping the files, to be converted on the device. Entries live in cache_dir/namespace, where the
+    namespace identifies the model, so embeddings of different models never mix.
+    Least recently used files are deleted once the cache takes more than max_bytes.
+    '''
+    def __init__(self, cache_dir: str, max_bytes: int, namespace: str = 'default'):
+        self.cache_dir = os.path.join(cache_dir, namespace)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # name -> [last access time, bytes], rebuilt from the files left by previous runs
+        self.entries = {}
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                self.entries[entry.name[:-len('.npy')]] = [stat.st_mtime, stat.st_size]
+        self.nbytes = sum(nbytes for _, nbytes in self.entries.values())
+        self._evict(0)
+
+    def get(self, key: Hashable) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        name = self._name(key)
+        features_path, meta_path = self._paths(name)
+        try:
+            # the .json file is written last, so an entry with it is complete
+            with open(meta_path) as f:
+                meta = json.load(f)
+            # copy-on-write map, torch does not wrap read-only arrays
+            features = np.load(features_path, mmap_mode='c')
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(features_path)
+        if name in self.entries:
+            self.entries[name][0] = time.time()
+        self.hits += 1
+        return torch.from_numpy(features), tuple(meta['original_size']), tuple(meta['input_size'])
+
+    def put(self, key: Hashable, features: torch.Tensor, original_size: Tuple[int, ...], input_size: Tuple[int, ...]):
+        name = self._name(key)
+        features_path, meta_path = self._paths(name)
+        features = features.detach().to('cpu', torch.float16).numpy()
+        if features.nbytes > self.max_bytes:
+            return
+        self._remove(name)
+        self._evict(features.nbytes)
+        # write to temporary files first, so an interrupted write is never read
+        with open(features_path + '.tmp', 'wb') as f:
+            np.save(f, features)
+        os.replace(features_path + '.tmp', features_path)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'original_size': list(original_size), 'input_size': list(input_size)}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        nbytes = os.path.getsize(features_path)
+        self.entries[name] = [time.time(), nbytes]
+        self.nbytes += nbytes
+
+    def clear(self):
+        for name in list(self.entries):
+            self._remove(name)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return os.path.exists(self._paths(self._name(key))[1])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _evict(self, nbytes: int):
+        for name, _ in sorted(self.entries.items(), key=lambda item: item[1][0]):
+            if self.nbytes + nbytes <= self.max_bytes:
+                break
+            self._remove(name)
+
+    def _remove(self, name: str):
+        for path in self._paths(name):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if name in self.entries:
+            self.nbytes -= self.entries.pop(name)[1]
+
+    def _paths(self, name: str) -> Tuple[str, str]:
+        path = os.path.join(self.cache_dir, name)
+        return path + '.npy', path + '.json'
+
+    @staticmethod
+    def _name(key: Hashable) -> str:
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
@@ -0,0 +1,81 @@
+import inspect
+import os
+from typing import Callable
+
+import torch
+
+# memory-mapped torch.load needs torch >= 2.1
+MMAP_SUPPORTED = 'mmap' in inspect.signature(torch.load).parameters
+
+
+def flat_checkpoint_path(checkpoint: str, tag: str = '') -> str:
+    '''
+    Path of the flat copy of checkpoint, next to it. tag tells apart flat copies of differently built models.
+    '''
+    return '{}{}.flat.pth'.format(os.path.splitext(checkpoint)[0], tag)
+
+
+def save_flat(model: torch.nn.Module, path: str):
+    '''
+    Saves every parameter and buffer of model, including non-persistent buffers, as contiguous cpu tensors
+    in a plain dict, which torch.load can memory-map.
+    '''
+    tensors = {}
+    for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+        tensors[name] = tensor.detach().cpu().contiguous()
+    # write to a temporary file first, so an interrupted save is never loaded
+    torch.save(tensors, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_flat_model(flat_path: str,
+                    build_empty: Callable[[], torch.nn.Module],
+                    build_loaded: Callable[[], torch.nn.Module],
+                    device) -> torch.nn.Module:
+    '''
+    Builds a model from its flat checkpoint: modules are constructed on the meta device, so no weights are
+    initialized, then the memory-mapped tensors of the flat checkpoint are assigned to them. Weights are read
+    from disk once, while being moved to the device; on cpu they stay mapped and are shared with the page cache.
+    The first time, when there is no flat checkpoint yet, the model is built with build_loaded and converted.
+    build_empty: builds the model without loading weights
+    build_loaded: builds the model from the original checkpoint
+    '''
+    if not MMAP_SUPPORTED:
+        return build_loaded().to(device)
+    if not os.path.exists(flat_path):
+        model = build_loaded()
+        try:
+            save_flat(model, flat_path)
+        except OSError as e:
+            print('Could not write flat checkpoint {}: {}'.format(flat_path, e))
+        return model.to(device)
+
+    try:
+        with torch.device('meta'):
+            model = build_empty()
+    except (RuntimeError, NotImplementedError) as e:
+        # e.g. Swin's drop path rates, read with .item() in __init__
+        print('Could not build the model on the meta device ({}), loading the original checkpoint'.format(e))
+        return build_loaded().to(device)
+    tensors = torch.load(flat_path, map_location='cpu', mmap=True, weights_only=True)
+    for name, tensor in tensors.items():
+        module_name, _, tensor_name = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = torch.nn.Parameter(
+                tensor, requires_grad=module._parameters[tensor_name].requires_grad)
+        else:
+            module._buffers[tensor_name] = tensor
+    if has_meta_tensors(model):
+        # e.g. tied weights, or tensors created in __init__ that are neither parameters nor buffers
+        print('Flat checkpoint {} does not cover the model, loading the original checkpoint'.format(flat_path))
+        return build_loaded().to(device)
+    return model.to(device)
+
+
+def has_meta_tensors(model: torch.nn.Module) -> bool:
+    for module in model.modules():
+        for value in list(module._parameters.values()) + list(module._buffers.values()) + list(vars(module).values()):
+            if isinstance(value, torch.Tensor) and value.is_meta:
+                return True
+    return False
@@ -0,0 +1,29 @@
+import threading
+from typing import Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+# process-wide models, shared by every SegTracker
+_models = {}
+_lock = threading.Lock()
+
+
+def get_model(key: Hashable, build: Callable[[], T]) -> T:
+    '''
+    Returns the model registered under key, building it with build() on first use.
+    key: identifies the weights, e.g. ('sam', model_type, checkpoint, device)
+    Registered models are shared across sessions, so they must only be used for inference;
+    per-session state (image embeddings, tracker memories) belongs to the caller.
+    '''
+    with _lock:
+        if key not in _models:
+            _models[key] = build()
+        return _models[key]
+
+
+def release_models():
+    '''
+    Drops every registered model, e.g. to free GPU memory. Sessions holding a model keep it alive.
+    '''
+    with _lock:
+        _models.clear()
@@ -1,14 +1,19 @@
+import os
 import time
 import torch
 import cv2
 from PIL import Image, ImageDraw, ImageOps
 import numpy as np
 from typing import Union
-from sam.segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator
+from sam.segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator, OnnxSam, SamOnnxPredictor
+from sam.segment_anything.utils.quantization import build_quantized_sam
 import matplotlib.pyplot as plt
 import PIL
 from .mask_painter import mask_painter
 from .painter import  point_painter
+from .embedding_cache import EmbeddingCache, DiskEmbeddingCache, frame_fingerprint
+from .model_registry import get_model
+from .fast_load import flat_checkpoint_path, load_flat_model
 
 mask_color = 3
 mask_alpha = 0.7
@@ -30,33 +35,140 @@ class Segmentor:
             sam_checkpoint: path of SAM checkpoint
             generator_args: args for everything_generator
             gpu_id: device
+            embedding_cache_mb: (optional) memory cap of the image embedding cache, in MB
+            attn_impl: (optional) attention kernel of the image encoder: default, sdpa, or chunked
+            image_size: (optional) input size of the image encoder, e.g. 512 or 768 for small frames
+            quantize: (optional) use a dynamic int8 quantized model, CPU only
+            quantized_checkpoint: (optional) on-disk cache of the quantized weights,
+                next to sam_checkpoint by default
+            backend: (optional) torch, or onnx to run the image encoder and mask decoder with onnxruntime on cpu
+            onnx_encoder / onnx_decoder: (optional) ONNX models exported by sam/scripts/export_onnx_model.py,
+                next to sam_checkpoint by default
+            onnx_threads: (optional) intra-op threads of onnxruntime
+            embedding_cache_dir: (optional) directory of an on-disk embedding cache kept across runs, disabled if None
+            embedding_cache_disk_mb: (optional) size cap of the on-disk embedding cache, in MB
+            fast_load: (optional) convert the checkpoint once to a flat file next to it, then build the model
+                on the meta device and memory-map the weights from that file
         """
         print(f"Initializing Segmentor to {sam_args['gpu_id']}")
         assert sam_args["model_type"] in ['vit_b', 'vit_l', 'vit_h'], 'model_type must be vit_b, vit_l, or vit_h'
 
         self.device = sam_args["gpu_id"]
         # self.torch_dtype = torch.float16 if 'cuda' in sam_args["gpu_id"] else torch.float32
-        self.model = sam_model_registry[sam_args["model_type"]](checkpoint=sam_args["sam_checkpoint"])
-        self.model.to(device=self.device)
-        self.everything_generator = SamAutomaticMaskGenerator(model=self.model,**sam_args['generator_args'])
-        self.interactive_predictor = self.everything_generator.predictor
-        self.embedded = False
+        build_args = {
+            'attn_impl': sam_args.get("attn_impl", "default"),
+            'image_size': sam_args.get("image_size", 1024),
+        }
+        backend = sam_args.get("backend", "torch")
+        if backend != 'onnx' and sam_args.get("quantize", False):
+            backend = 'int8'
+        if backend in ['onnx', 'int8']:
+            assert str(self.device) == 'cpu', '{} SAM only runs on cpu'.format(backend)
 
-    @torch.no_grad()
-    def set_image(self, image: np.ndarray):
-        # image embedding: avoid encode the same image multiple times
+        # weights are loaded once per process and shared by all Segmentors, the predictor state is per Segmentor
+        model_key = ('sam', sam_args["model_type"], sam_args["sam_checkpoint"], str(self.device), backend,
+                     build_args['attn_impl'], build_args['image_size'], sam_args.get("quantized_checkpoint"),
+                     sam_args.get("onnx_encoder"), sam_args.get("onnx_decoder"))
+        self.model = get_model(model_key, lambda: self.build_model(sam_args, build_args, backend))
+        if backend == 'onnx':
+            self.interactive_predictor = SamOnnxPredictor(self.model)
+        else:
+            self.interactive_predictor = SamPredictor(self.model)
+
+        self.disk_cache = None
+        if sam_args.get('embedding_cache_dir') is not None:
+            # embeddings depend on the weights, input size and backend
+            checkpoint_name = os.path.splitext(os.path.basename(str(sam_args["sam_checkpoint"])))[0]
+            namespace = '{}_{}_{}_{}'.format(sam_args["model_type"], checkpoint_name, build_args['image_size'], backend)
+            self.disk_cache = DiskEmbeddingCache(sam_args['embedding_cache_dir'],
+                                                 sam_args.get('embedding_cache_disk_mb', 4096) * 2**20,
+                                                 namespace)
+        # embeddings are shared like the weights, so a new session on the same frame does not re-encode it
+        self.embedding_cache = get_model(('sam_embeddings',) + model_key,
+                                         lambda: EmbeddingCache(sam_args.get('embedding_cache_mb', 256) * 2**20))
+        self.generator_args = dict(sam_args['generator_args'])
+        self._everything_generator = None
+        self.frame_key = None
+
+    def build_model(self, sam_args, build_args, backend):
+        if backend == 'onnx':
+            prefix = os.path.splitext(sam_args["sam_checkpoint"])[0]
+            return OnnxSam(sam_args.get("onnx_encoder", prefix + '_encoder.onnx'),
+                           sam_args.get("onnx_decoder", prefix + '_decoder.onnx'),
+                           num_threads=sam_args.get("onnx_threads"))
+        if backend == 'int8':
+            quantized_checkpoint = sam_args.get("quantized_checkpoint")
+            if quantized_checkpoint is None and sam_args["sam_checkpoint"] is not None:
+                quantized_checkpoint = '{}_int8_{}.pth'.format(os.path.splitext(sam_args["sam_checkpoint"])[0], build_args['image_size'])
+            model = build_quantized_sam(sam_args["model_type"], sam_args["sam_checkpoint"], quantized_checkpoint, **build_args)
+        elif sam_args.get("fast_load", False) and sam_args["sam_checkpoint"] is not None:
+            build_sam = sam_model_registry[sam_args["model_type"]]
+            # the flat checkpoint holds the positional embeddings resampled to image_size
+            flat_checkpoint = flat_checkpoint_path(sam_args["sam_checkpoint"], '_{}'.format(build_args['image_size']))
+            model = load_flat_model(flat_checkpoint,
+                                    lambda: build_sam(**build_args),
+                                    lambda: build_sam(checkpoint=sam_args["sam_checkpoint"], **build_args),
+                                    self.device)
+        else:
+            model = sam_model_registry[sam_args["model_type"]](checkpoint=sam_args["sam_checkpoint"], **build_args)
+        model.to(device=self.device)
+        model.eval()
+        return model
 
-        if self.embedded:
+    @property
+    def everything_generator(self):
+        # built on first use, it shares the interactive predictor
+        if self._everything_generator is None:
+            self._everything_generator = SamAutomaticMaskGenerator(model=self.interactive_predictor,
+                                                                   embedding_cache=self.disk_cache,
+                                                                   **self.generator_args)
+        return self._everything_generator
+
+    @property
+    def embedded(self):
+        # the everything_generator shares the predictor and may have reset it
+        return self.interactive_predictor.is_image_set
+
+    @torch.no_grad()
+    def set_image(self, image: np.ndarray, frame_key=None):
+        '''
+        image embedding: avoid encode the same image multiple times
+        frame_key: optional identity of the frame, e.g. (video hash, frame index). The content hash of the image is used by default.
+            The embedding cache is shared by all Segmentors of the process, so the key must be unique across videos.
+        '''
+        if frame_key is None:
+            frame_key = frame_fingerprint(image)
+        if self.embedded and frame_key == self.frame_key:
             return
-        self.interactive_predictor.set_image(image)
-        self.embedded = True
+
+        cached = self.embedding_cache.get(frame_key)
+        if cached is None and self.disk_cache is not None:
+            # same key as the full-image crop of the everything_generator
+            cached = self.disk_cache.get((frame_key, (0, 0, image.shape[1], image.shape[0])))
+            if cached is not None:
+                cached = (cached[0].to(self.device).float(),) + cached[1:]
+                self.embedding_cache.put(frame_key, *cached)
+        if cached is not None:
+            self.interactive_predictor.set_image_embedding(*cached)
+        else:
+            self.interactive_predictor.set_image(image)
+            self.embedding_cache.put(frame_key,
+                                     self.interactive_predictor.features,
+                                     self.interactive_predictor.original_size,
+                                     self.interactive_predictor.input_size)
+            if self.disk_cache is not None:
+                self.disk_cache.put((frame_key, (0, 0, image.shape[1], image.shape[0])),
+                                    self.interactive_predictor.features,
+                                    self.interactive_predictor.original_size,
+                                    self.interactive_predictor.input_size)
+        self.frame_key = frame_key
         return
     
     @torch.no_grad()
     def reset_image(self):
-        # reset image embeding
+        # reset image embeding, cached embeddings are kept
         self.interactive_predictor.reset_image()
-        self.embedded = False
+        self.frame_key = None
 
     def interactive_predict(self, prompts, mode, multimask=True):
         """
@@ -117,6 +229,61 @@ class Segmentor:
         outline = mask_painter(origin_frame.copy(), mask.astype('uint8'), mask_color, mask_alpha, contour_color, contour_width)
         return mask.astype(np.uint8), logit, outline
 
+    @torch.no_grad()
+    def segment_with_clicks(self, origin_frame: np.ndarray, points_list, labels_list, logits_list=None, multimask=True):
+        '''
+            segment_with_click for K objects at once: each refinement pass runs the mask decoder
+            on one batch with all objects, instead of once per object.
+            points_list: list of K numpy arrays [N_k,2]
+            labels_list: list of K numpy arrays [N_k]
+            logits_list: (optional) list of K previous logits [256,256] or None, e.g. from an earlier call.
+                An object with previous logits uses them as mask input of the first pass.
+            objects with fewer clicks are padded with ignored points (label -1), as the ONNX decoder does
+            return:
+                masks: numpy array [K,h,w], one-hot per object
+                logits: numpy array [K,256,256]
+        '''
+        assert len(points_list) == len(labels_list)
+        if logits_list is None:
+            logits_list = [None] * len(points_list)
+        self.set_image(origin_frame)
+        predictor = self.interactive_predictor
+        num_objs = len(points_list)
+        obj_range = torch.arange(num_objs)
+
+        num_points = max(len(points) for points in points_list)
+        coords = np.zeros((num_objs, num_points, 2))
+        labels = -np.ones((num_objs, num_points))
+        for i, (points, point_labels) in enumerate(zip(points_list, labels_list)):
+            assert len(points) == len(point_labels)
+            coords[i, :len(points)] = points
+            labels[i, :len(points)] = point_labels
+        coords = predictor.transform.apply_coords(coords, origin_frame.shape[:2])
+        coords = torch.as_tensor(coords, dtype=torch.float, device=predictor.device)
+        labels = torch.as_tensor(labels, dtype=torch.int, device=predictor.device)
+
+        # first pass: points (and previous logits), only the low-res logits are needed
+        first_logits = torch.zeros(num_objs, 1, *predictor.model.prompt_encoder.mask_input_size, device=predictor.device)
+        for with_prev_logits in [False, True]:
+            idx = [i for i, logit in enumerate(logits_list) if (logit is not None) == with_prev_logits]
+            if len(idx) == 0:
+                continue
+            mask_input = None
+            if with_prev_logits:
+                mask_input = np.stack([np.reshape(logits_list[i], logits_list[i].shape[-2:]) for i in idx])[:, None]
+                mask_input = torch.as_tensor(mask_input, dtype=torch.float, device=predictor.device)
+            _, scores, logits = predictor.predict_torch(coords[idx], labels[idx], mask_input=mask_input,
+                                                        multimask_output=multimask, upscale_masks=False)
+            best = scores.argmax(dim=1)
+            first_logits[idx] = logits[torch.arange(len(idx)), best][:, None]
+
+        # second pass: points and the best logits of the first pass, all objects in one batch
+        masks, scores, logits = predictor.predict_torch(coords, labels, mask_input=first_logits, multimask_output=multimask)
+        best = scores.argmax(dim=1)
+        masks = masks[obj_range, best].cpu().numpy().astype(np.uint8)
+        logits = logits[obj_range, best].cpu().numpy()
+        return masks, logits
+
     def segment_with_box(self, origin_frame, bbox):
         self.set_image(origin_frame)
 